@@ -0,0 +1,96 @@
+"""Compare full and chunked `d2l.DotProductAttention` on long sequences.
+
+Run from the repository root:
+
+    python benchmarks/attention_chunked.py [--batch 8] [--chunk-size 512]
+        [lengths ...]
+
+Every sample runs in a fresh interpreter, so the reported memory is the
+growth of its peak resident set size caused by a single forward pass
+(without gradients), on top of the inputs. Chunking is enabled on an
+existing model by setting `chunk_size` on its `DotProductAttention`
+modules.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import resource, sys, time
+import torch
+from d2l import torch as d2l
+
+def peak_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # `ru_maxrss` is in bytes on macOS and in kilobytes elsewhere
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+torch.manual_seed(0)
+batch, length, dim = {batch}, {length}, {dim}
+queries, keys, values = torch.randn(3, batch, length, dim).unbind(0)
+valid_lens = torch.randint(length // 2, length + 1, (batch,))
+attention = d2l.DotProductAttention(0, chunk_size={chunk_size})
+attention.eval()
+base = peak_mb()
+with torch.no_grad():
+    start = time.perf_counter()
+    output = attention(queries, keys, values, valid_lens)
+    elapsed = time.perf_counter() - start
+    memory, error = peak_mb() - base, float('nan')
+    if {check}:
+        attention.chunk_size = None
+        expected = attention(queries, keys, values, valid_lens)
+        error = (output - expected).abs().max().item()
+print(elapsed, memory, error)
+"""
+
+
+def measure(length, args, chunk_size, repeat):
+    """Return the times, peak memory growth and maximum absolute error."""
+    check = chunk_size is not None and length <= args.check_max
+    times, memory, error = [], [], float('nan')
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, '-c', CHILD.format(
+                batch=args.batch, length=length, dim=args.dim,
+                chunk_size=chunk_size, check=check)],
+            cwd=ROOT, capture_output=True, text=True)
+        if out.returncode != 0:
+            return None
+        t, m, error = map(float, out.stdout.split())
+        times.append(t)
+        memory.append(m)
+    return statistics.median(times), statistics.median(memory), error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('lengths', nargs='*', type=int,
+                        default=[128, 256, 512, 1024, 2048, 4096, 8192])
+    parser.add_argument('--batch', type=int, default=8,
+                        help='batch size times number of heads')
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=512)
+    parser.add_argument('--check-max', type=int, default=4096,
+                        help='longest length compared with the full path')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    print(f'{"length":>8}{"full (s)":>11}{"full (MB)":>11}'
+          f'{"chunked (s)":>13}{"chunked (MB)":>14}{"max error":>11}')
+    for length in args.lengths:
+        full = measure(length, args, None, args.repeat)
+        chunked = measure(length, args, args.chunk_size, args.repeat)
+        row = f'{length:>8}'
+        row += (f'{full[0]:>11.3f}{full[1]:>11.1f}' if full
+                else f'{"failed":>11}{"-":>11}')
+        row += (f'{chunked[0]:>13.3f}{chunked[1]:>14.1f}{chunked[2]:>11.1e}'
+                if chunked else f'{"failed":>13}{"-":>14}{"-":>11}')
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Compare batched `d2l.multibox_detection` with the per-image implementation.
+
+Run from the repository root:
+
+    python benchmarks/multibox_detection.py [--batch 32] [--top-k 500]
+        [--modes loop bitmask] [scales ...]
+
+Predictions are random class probabilities and offsets for the 5444 anchors
+of the TinySSD model of the SSD section; `scales` are the standard
+deviations of the offsets, so larger scales scatter the predicted boxes
+more. Every NMS mode is checked to give outputs identical to the reference
+implementation kept below. With `--top-k`, only the boxes of the highest
+scores take part in NMS. Since the fate of a box only depends on boxes of
+higher scores, its detections (rows of non-background classes) are checked
+to be the first detections of the reference.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from d2l import torch as d2l  # noqa: E402
+from multibox_target import ssd_anchors  # noqa: E402
+
+
+def reference_nms(boxes, scores, iou_threshold):
+    """The NMS loop that `d2l.nms` replaced."""
+    B = torch.argsort(scores, dim=-1, descending=True)
+    keep = []
+    while B.numel() > 0:
+        i = B[0]
+        keep.append(i)
+        if B.numel() == 1: break
+        iou = d2l.box_iou(boxes[i, :].reshape(-1, 4),
+                          boxes[B[1:], :].reshape(-1, 4)).reshape(-1)
+        inds = torch.nonzero(iou <= iou_threshold).reshape(-1)
+        B = B[inds + 1]
+    return d2l.tensor(keep, device=boxes.device)
+
+
+def reference_multibox_detection(cls_probs, offset_preds, anchors,
+                                 nms_threshold=0.5,
+                                 pos_threshold=0.009999999):
+    """The per-image `multibox_detection` that the batched version replaced."""
+    device, batch_size = cls_probs.device, cls_probs.shape[0]
+    anchors = anchors.squeeze(0)
+    num_classes, num_anchors = cls_probs.shape[1], cls_probs.shape[2]
+    out = []
+    for i in range(batch_size):
+        cls_prob, offset_pred = cls_probs[i], offset_preds[i].reshape(-1, 4)
+        conf, class_id = torch.max(cls_prob[1:], 0)
+        predicted_bb = d2l.offset_inverse(anchors, offset_pred)
+        keep = reference_nms(predicted_bb, conf, nms_threshold)
+        all_idx = torch.arange(num_anchors, dtype=torch.long, device=device)
+        combined = torch.cat((keep, all_idx))
+        uniques, counts = combined.unique(return_counts=True)
+        non_keep = uniques[counts == 1]
+        all_id_sorted = torch.cat((keep, non_keep))
+        class_id[non_keep] = -1
+        class_id = class_id[all_id_sorted]
+        conf, predicted_bb = conf[all_id_sorted], predicted_bb[all_id_sorted]
+        below_min_idx = (conf < pos_threshold)
+        class_id[below_min_idx] = -1
+        conf[below_min_idx] = 1 - conf[below_min_idx]
+        pred_info = torch.cat(
+            (class_id.unsqueeze(1), conf.unsqueeze(1), predicted_bb), dim=1)
+        out.append(pred_info)
+    return d2l.stack(out)
+
+
+def detections(output):
+    """Return the rows of non-background classes of each example."""
+    return [out[out[:, 0] >= 0] for out in output]
+
+
+def timed(fn, *args, **kwargs):
+    """Return the output of a call and the time it took."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scales', nargs='*', type=float,
+                        default=[0.1, 0.5, 2])
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--num-classes', type=int, default=1)
+    parser.add_argument('--modes', nargs='*', default=['loop', 'bitmask'])
+    parser.add_argument('--top-k', type=int, default=500)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    anchors = ssd_anchors()
+    num_anchors = anchors.shape[1]
+    columns = ['reference'] + args.modes + [f'top {args.top_k}']
+    print(f'{"scale":>6}{"kept":>7}' + ''.join(
+        f'{name + " (s)":>15}' for name in columns))
+    for scale in args.scales:
+        cls_probs = torch.softmax(2 * torch.randn(
+            args.batch, args.num_classes + 1, num_anchors), dim=1)
+        offset_preds = scale * torch.randn(args.batch, num_anchors * 4)
+        inputs = (cls_probs, offset_preds, anchors)
+        expected, reference = timed(reference_multibox_detection, *inputs)
+        times = [reference]
+        for mode in args.modes:
+            output, elapsed = timed(d2l.multibox_detection, *inputs,
+                                    nms_mode=mode)
+            assert torch.equal(output, expected), \
+                f'Outputs of mode {mode} differ from the reference.'
+            times.append(elapsed)
+        output, elapsed = timed(d2l.multibox_detection, *inputs,
+                                pre_nms_top_k=args.top_k)
+        assert all(torch.equal(a, b[:len(a)]) for a, b in zip(
+            detections(output), detections(expected))), \
+            'Detections with top-k pre-filtering differ from the reference.'
+        times.append(elapsed)
+        kept = sum(len(d) for d in detections(expected)) / args.batch
+        print(f'{scale:>6}{kept:>7.0f}' + ''.join(
+            f'{t:>15.3f}' for t in times))
+
+
+if __name__ == '__main__':
+    main()
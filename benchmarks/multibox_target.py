@@ -0,0 +1,147 @@
+"""Compare batched `d2l.multibox_target` with the per-image implementation.
+
+Run from the repository root:
+
+    python benchmarks/multibox_target.py [--batch 32] [--boxes 1 4 8]
+        [--bananas] [anchors ...]
+
+Ground-truth labels are random boxes padded with -1 rows, like those of
+`d2l.load_data_bananas`. With `--bananas`, the labels of the banana
+detection training set are checked as well, with the 5444 anchors of the
+TinySSD model of the SSD section. Every result is checked to be identical
+to the reference implementation kept below.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from d2l import torch as d2l  # noqa: E402
+
+
+def reference_assign_anchor_to_bbox(ground_truth, anchors, device):
+    """The per-ground-truth loop that `assign_anchor_to_bbox` replaced."""
+    num_anchors, num_gt_boxes = anchors.shape[0], ground_truth.shape[0]
+    jaccard = d2l.box_iou(anchors, ground_truth)
+    anchors_bbox_map = torch.full((num_anchors,), -1, dtype=torch.long,
+                                  device=device)
+    max_ious, indices = torch.max(jaccard, dim=1)
+    anc_i = torch.nonzero(max_ious >= 0.5).reshape(-1)
+    box_j = indices[max_ious >= 0.5]
+    anchors_bbox_map[anc_i] = box_j
+    col_discard = torch.full((num_anchors,), -1)
+    row_discard = torch.full((num_gt_boxes,), -1)
+    for _ in range(num_gt_boxes):
+        max_idx = torch.argmax(jaccard)
+        box_idx = (max_idx % num_gt_boxes).long()
+        anc_idx = (max_idx / num_gt_boxes).long()
+        anchors_bbox_map[anc_idx] = box_idx
+        jaccard[:, box_idx] = col_discard
+        jaccard[anc_idx, :] = row_discard
+    return anchors_bbox_map
+
+
+def reference_multibox_target(anchors, labels):
+    """The per-image `multibox_target` that the batched version replaced."""
+    batch_size, anchors = labels.shape[0], anchors.squeeze(0)
+    batch_offset, batch_mask, batch_class_labels = [], [], []
+    device, num_anchors = anchors.device, anchors.shape[0]
+    for i in range(batch_size):
+        label = labels[i, :, :]
+        anchors_bbox_map = reference_assign_anchor_to_bbox(
+            label[:, 1:], anchors, device)
+        bbox_mask = ((anchors_bbox_map >= 0).float().unsqueeze(-1)).repeat(
+            1, 4)
+        class_labels = torch.zeros(num_anchors, dtype=torch.long,
+                                   device=device)
+        assigned_bb = torch.zeros((num_anchors, 4), dtype=torch.float32,
+                                  device=device)
+        indices_true = torch.nonzero(anchors_bbox_map >= 0)
+        bb_idx = anchors_bbox_map[indices_true]
+        class_labels[indices_true] = label[bb_idx, 0].long() + 1
+        assigned_bb[indices_true] = label[bb_idx, 1:]
+        offset = d2l.offset_boxes(anchors, assigned_bb) * bbox_mask
+        batch_offset.append(offset.reshape(-1))
+        batch_mask.append(bbox_mask.reshape(-1))
+        batch_class_labels.append(class_labels)
+    return (torch.stack(batch_offset), torch.stack(batch_mask),
+            torch.stack(batch_class_labels))
+
+
+def random_labels(batch_size, max_boxes, num_classes=3):
+    """Return random labels with 1 to `max_boxes` boxes per image."""
+    labels = -torch.ones(batch_size, max_boxes, 5)
+    for i in range(batch_size):
+        n = torch.randint(1, max_boxes + 1, ()).item()
+        # Sort two random points into upper-left and lower-right corners
+        corners = torch.rand(n, 2, 2).sort(dim=1)[0]
+        labels[i, :n, 0] = torch.randint(0, num_classes, (n,)).float()
+        labels[i, :n, 1:] = corners.reshape(n, 4)
+    return labels
+
+
+def ssd_anchors():
+    """Return the anchors of TinySSD on 256 x 256 banana images."""
+    sizes = [[0.2, 0.272], [0.37, 0.447], [0.54, 0.619], [0.71, 0.79],
+             [0.88, 0.961]]
+    ratios = [[1, 2, 0.5]] * 5
+    return torch.cat([
+        d2l.multibox_prior(torch.zeros(1, 1, size, size), sizes[i],
+                           ratios[i])
+        for i, size in enumerate((32, 16, 8, 4, 1))], dim=1)
+
+
+def compare(anchors, labels, repeat=3):
+    """Return the times of both implementations, checking equal outputs."""
+    times = []
+    for fn in (reference_multibox_target, d2l.multibox_target):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = fn(anchors, labels)
+        times.append((time.perf_counter() - start) / repeat)
+        if fn is reference_multibox_target:
+            expected = result
+    assert all(a.dtype == b.dtype and torch.equal(a, b)
+               for a, b in zip(expected, result)), \
+        'Outputs differ from the reference implementation.'
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('anchors', nargs='*', type=int,
+                        default=[5444, 10000, 20000, 50000])
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--boxes', nargs='*', type=int, default=[1, 4, 8])
+    parser.add_argument('--bananas', action='store_true')
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    print(f'{"anchors":>8}{"boxes":>7}{"reference (s)":>15}'
+          f'{"batched (s)":>13}{"speedup":>9}')
+    for num_anchors in args.anchors:
+        # Anchors of a square feature map, cut to the requested number
+        side = int((num_anchors / 4) ** 0.5) + 1
+        anchors = d2l.multibox_prior(torch.zeros(1, 1, side, side),
+                                     [0.2, 0.3, 0.5], [1, 2, 0.5])
+        anchors = anchors[:, :num_anchors]
+        for max_boxes in args.boxes:
+            labels = random_labels(args.batch, max_boxes)
+            reference, batched = compare(anchors, labels)
+            print(f'{num_anchors:>8}{max_boxes:>7}{reference:>15.4f}'
+                  f'{batched:>13.4f}{reference / batched:>9.1f}')
+    if args.bananas:
+        anchors = ssd_anchors()
+        train_iter, _ = d2l.load_data_bananas(args.batch)
+        reference = batched = 0
+        for _, labels in train_iter:
+            times = compare(anchors, labels, repeat=1)
+            reference, batched = reference + times[0], batched + times[1]
+        print(f'bananas: identical outputs, {reference:.2f} s per epoch '
+              f'before, {batched:.2f} s after')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Measure the time and memory needed to import each d2l backend.
+
+Run from the repository root:
+
+    python benchmarks/startup.py [--repeat 5] [torch mxnet tensorflow]
+
+Every sample runs in a fresh interpreter so that nothing is cached in
+`sys.modules`. The reported RSS is the peak resident set size of that
+interpreter after the import.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import sys, time
+t = time.perf_counter()
+from d2l import {backend} as d2l
+elapsed = time.perf_counter() - t
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # `ru_maxrss` is in bytes on macOS and in kilobytes elsewhere
+    rss = rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+except ImportError:
+    rss = float('nan')
+heavy = [m for m in ('pandas', 'matplotlib', 'IPython', 'torchvision', 'PIL',
+                     'requests') if m in sys.modules]
+print(elapsed, rss, ','.join(heavy))
+"""
+
+
+def measure(backend, repeat):
+    """Return the import times, peak RSS values and heavy modules loaded."""
+    times, rss = [], []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c',
+                              CHILD.format(backend=backend)], cwd=ROOT,
+                             capture_output=True, text=True)
+        if out.returncode != 0:
+            return None
+        t, r, heavy = (out.stdout.strip().split(' ') + [''])[:3]
+        times.append(float(t))
+        rss.append(float(r))
+    return times, rss, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('backends', nargs='*',
+                        default=['torch', 'mxnet', 'tensorflow'])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print(f'{"backend":<12}{"import (s)":>12}{"peak RSS (MB)":>16}  '
+          f'heavy modules loaded')
+    for backend in args.backends:
+        result = measure(backend, args.repeat)
+        if result is None:
+            print(f'{backend:<12}{"not installed":>12}')
+            continue
+        times, rss, heavy = result
+        print(f'{backend:<12}{statistics.median(times):>12.3f}'
+              f'{statistics.median(rss):>16.1f}  {heavy or "-"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Compare the flat word2vec data pipeline with the list-based implementation.
+
+Run from the repository root:
+
+    python benchmarks/word2vec_data.py [--sentences 42000] [--vocab 10000]
+        [--window 5] [--noise 5] [--ptb]
+
+Sentences are drawn from a Zipf distribution over a synthetic vocabulary,
+sized like the PTB training set; with `--ptb`, the PTB dataset itself is
+used. Both pipelines draw random numbers from different generators, so
+their outputs are compared by statistics instead: the token counts must be
+equal, the numbers of kept tokens, centers and context words must be close,
+no noise word may be a context word of its center, and the distributions of
+noise words must be close.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from d2l import torch as d2l  # noqa: E402
+
+
+def zipf_sentences(num_sentences, num_words, max_len=40, seed=0):
+    """Return random sentences of words with Zipf-distributed frequencies."""
+    rng = np.random.default_rng(seed)
+    probs = 1 / np.arange(1, num_words + 1)
+    lengths = rng.integers(1, max_len, num_sentences)
+    words = rng.choice(num_words, lengths.sum(), p=probs / probs.sum())
+    words = [f'w{w}' for w in words.tolist()]
+    ends = np.cumsum(lengths).tolist()
+    return [words[i:j] for i, j in zip([0] + ends[:-1], ends)]
+
+
+def list_pipeline(sentences, vocab, max_window_size, num_noise_words):
+    """The pipeline that `load_data_ptb` used before the flat arrays."""
+    subsampled, counter = d2l.subsample(sentences, vocab)
+    corpus = [vocab[line] for line in subsampled]
+    centers, contexts = d2l.get_centers_and_contexts(corpus, max_window_size)
+    negatives = d2l.get_negatives(contexts, vocab, counter, num_noise_words)
+    return counter, corpus, centers, contexts, negatives
+
+
+def flat_pipeline(sentences, vocab, max_window_size, num_noise_words, seed):
+    """The pipeline of `load_data_ptb` on flat arrays."""
+    rng = np.random.default_rng(seed)
+    indices, offsets, counts = d2l.subsample_flat(*vocab.encode(sentences),
+                                                  vocab, rng)
+    centers, contexts, context_offsets = d2l.get_centers_and_contexts_flat(
+        indices, offsets, max_window_size, rng)
+    negatives = d2l.get_negatives_flat(contexts, context_offsets, counts,
+                                       num_noise_words, rng)
+    return counts, indices, centers, contexts, context_offsets, negatives
+
+
+def timed(fn, *args):
+    """Return the output of a call and the time it took."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sentences', type=int, default=42000)
+    parser.add_argument('--vocab', type=int, default=10000)
+    parser.add_argument('--window', type=int, default=5)
+    parser.add_argument('--noise', type=int, default=5)
+    parser.add_argument('--ptb', action='store_true')
+    args = parser.parse_args()
+    sentences = (d2l.read_ptb() if args.ptb else
+                 zipf_sentences(args.sentences, args.vocab))
+    vocab = d2l.Vocab(sentences, min_freq=10)
+    random.seed(0)
+    (counter, corpus, centers, contexts, negatives), reference = timed(
+        list_pipeline, sentences, vocab, args.window, args.noise)
+    (counts, indices, flat_centers, flat_contexts, context_offsets,
+     flat_negatives), flat = timed(flat_pipeline, sentences, vocab,
+                                   args.window, args.noise, 0)
+    assert all(counts[vocab[token]] == count
+               for token, count in counter.items()), 'Token counts differ.'
+    rows = np.repeat(np.arange(len(flat_centers)),
+                     args.noise * np.diff(context_offsets))
+    starts, ends = context_offsets[rows], context_offsets[rows + 1]
+    assert not any(
+        negative in flat_contexts[start:end]
+        for negative, start, end in zip(flat_negatives[::97].tolist(),
+                                        starts[::97], ends[::97])), \
+        'A noise word is a context word of its center.'
+    freqs = [np.bincount(np.asarray(n), minlength=len(vocab)) / len(n)
+             for n in ([w for ws in negatives for w in ws], flat_negatives)]
+    print(f'{"":>16}{"list":>12}{"flat":>12}')
+    for name, before, after in (
+            ('kept tokens', sum(map(len, corpus)), len(indices)),
+            ('centers', len(centers), len(flat_centers)),
+            ('context words', sum(map(len, contexts)), len(flat_contexts)),
+            ('time (s)', reference, flat)):
+        print(f'{name:>16}{before:>12.6g}{after:>12.6g}')
+    print(f'noise word distributions differ by '
+          f'{np.abs(freqs[0] - freqs[1]).sum():.4f} (L1 distance)')
+
+
+if __name__ == '__main__':
+    main()
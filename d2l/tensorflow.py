@@ -4,7 +4,12 @@
 
 # Defined in file: ./chapter_preface/index.md
 import collections
+import concurrent.futures
+import contextlib
 import hashlib
+import importlib
+import itertools
+import json
 import math
 import os
 import random
@@ -12,17 +17,31 @@ import re
 import shutil
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 import zipfile
 from collections import defaultdict
 
-import pandas as pd
-import requests
-from IPython import display
-from matplotlib import pyplot as plt
-
 d2l = sys.modules[__name__]
 
+# Heavy dependencies that most headless jobs never touch are imported on first
+# access of `d2l.<name>` instead of at module load
+_LAZY_MODULES = {
+    'display': 'IPython.display',
+    'pd': 'pandas',
+    'plt': 'matplotlib.pyplot',
+    'requests': 'requests'}
+
+
+def __getattr__(name):
+    """Import the module behind a lazy attribute on first access."""
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(_LAZY_MODULES[name])
+    globals()[name] = module
+    return module
+
 
 # Defined in file: ./chapter_preface/index.md
 import numpy as np
@@ -32,7 +51,7 @@ import tensorflow as tf
 # Defined in file: ./chapter_preliminaries/calculus.md
 def use_svg_display():
     """Use the svg format to display a plot in Jupyter."""
-    display.set_matplotlib_formats('svg')
+    d2l.display.set_matplotlib_formats('svg')
 
 
 # Defined in file: ./chapter_preliminaries/calculus.md
@@ -301,8 +320,8 @@ class Animator:
         for x, y, fmt in zip(self.X, self.Y, self.fmts):
             self.axes[0].plot(x, y, fmt)
         self.config_axes()
-        display.display(self.fig)
-        display.clear_output(wait=True)
+        d2l.display.display(self.fig)
+        d2l.display.clear_output(wait=True)
 
 
 # Defined in file: ./chapter_linear-networks/softmax-regression-scratch.md
@@ -359,49 +378,229 @@ DATA_URL = 'http://d2l-data.s3-accelerate.amazonaws.com/'
 
 
 # Defined in file: ./chapter_multilayer-perceptrons/kaggle-house-price.md
-def download(name, cache_dir=os.path.join('..', 'data')):
+def _hash_file(fname, sha1=None):
+    """Feed the contents of `fname` into a SHA-1 object."""
+    if sha1 is None:
+        sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(1048576)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1
+
+
+def _write_manifest(fname, sha1_hash):
+    """Record the size, mtime and SHA-1 of `fname` in a sidecar file."""
+    st = os.stat(fname)
+    tmp = f'{fname}.manifest.{os.getpid()}.{threading.get_ident()}'
+    with open(tmp, 'w') as f:
+        json.dump({'size': st.st_size, 'mtime': st.st_mtime_ns,
+                   'sha1': sha1_hash}, f)
+    os.replace(tmp, fname + '.manifest')
+
+
+def file_sha1(fname):
+    """Return the SHA-1 of `fname`, skipping the hash if nothing changed."""
+    try:
+        with open(fname + '.manifest', 'r') as f:
+            manifest = json.load(f)
+        st = os.stat(fname)
+        if (manifest['size'], manifest['mtime']) == (st.st_size,
+                                                     st.st_mtime_ns):
+            return manifest['sha1']
+    except (OSError, ValueError, KeyError):
+        pass
+    sha1_hash = _hash_file(fname).hexdigest()
+    _write_manifest(fname, sha1_hash)
+    return sha1_hash
+
+
+def download(name, cache_dir=os.path.join('..', 'data'), session=None):
     """Download a file inserted into DATA_HUB, return the local filename."""
     assert name in DATA_HUB, f"{name} does not exist in {DATA_HUB}."
     url, sha1_hash = DATA_HUB[name]
     os.makedirs(cache_dir, exist_ok=True)
     fname = os.path.join(cache_dir, url.split('/')[-1])
-    if os.path.exists(fname):
-        sha1 = hashlib.sha1()
-        with open(fname, 'rb') as f:
-            while True:
-                data = f.read(1048576)
-                if not data:
-                    break
-                sha1.update(data)
-        if sha1.hexdigest() == sha1_hash:
-            return fname  # Hit cache
+    if os.path.exists(fname) and file_sha1(fname) == sha1_hash:
+        return fname  # Hit cache
     print(f'Downloading {fname} from {url}...')
-    r = requests.get(url, stream=True, verify=True)
-    with open(fname, 'wb') as f:
-        f.write(r.content)
+    get = d2l.requests.get if session is None else session.get
+    part_fname = fname + '.part'
+    sha1 = _fetch_part(get, url, part_fname)
+    if sha1.hexdigest() != sha1_hash:
+        # A stale or corrupt partial file was resumed: start over once
+        os.remove(part_fname)
+        sha1 = _fetch_part(get, url, part_fname)
+        if sha1.hexdigest() != sha1_hash:
+            os.remove(part_fname)
+            raise ValueError(f'SHA-1 of {url} is {sha1.hexdigest()}, '
+                             f'expected {sha1_hash}.')
+    os.replace(part_fname, fname)
+    _write_manifest(fname, sha1_hash)
     return fname
 
 
+def _fetch_part(get, url, part_fname):
+    """Download `url` into `part_fname` and return its SHA-1 object."""
+    # Stream into the `.part` file, hashing while writing, and resume it with
+    # a range request if an earlier download was interrupted
+    sha1, pos = hashlib.sha1(), 0
+    if os.path.exists(part_fname):
+        sha1, pos = _hash_file(part_fname), os.path.getsize(part_fname)
+    headers = {'Range': f'bytes={pos}-'} if pos else {}
+    with get(url, stream=True, verify=True, headers=headers) as r:
+        # 416 means the partial file already holds the whole content
+        if not (pos and r.status_code == 416):
+            r.raise_for_status()
+            if r.status_code != 206:
+                # The server ignored the range request, so start over
+                sha1, pos = hashlib.sha1(), 0
+            with open(part_fname, 'ab' if pos else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1048576):
+                    f.write(chunk)
+                    sha1.update(chunk)
+    return sha1
+
+
 # Defined in file: ./chapter_multilayer-perceptrons/kaggle-house-price.md
+@contextlib.contextmanager
+def _file_lock(lock_fname):
+    """Hold an exclusive lock on `lock_fname` across threads and processes."""
+    with open(lock_fname, 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # `LK_LOCK` gives up after 10 seconds
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield  # The lock is released when `f` is closed
+
+
+def _map_chunks(fn, items, max_workers, dirs=()):
+    """Call `fn` on up to `max_workers` chunks of `items` in threads."""
+    # Create the directories up front so that workers do not race on them
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    chunk_size = max(1, math.ceil(len(items) / max_workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        list(executor.map(fn, [items[i:i + chunk_size]
+                               for i in range(0, len(items), chunk_size)]))
+
+
+def _extract_members(fname, ext, dest, max_workers=8):
+    """Extract an archive into `dest`, unpacking its files in parallel."""
+    if ext == '.gz':
+        # Members of a compressed tar can only be read in order
+        with tarfile.open(fname, 'r') as fp:
+            fp.extractall(dest)
+        return
+    if ext == '.zip':
+        open_archive = lambda: zipfile.ZipFile(fname, 'r')
+        with open_archive() as fp:
+            members = fp.infolist()
+        files = [m for m in members if not m.is_dir()]
+        names = [m.filename for m in members]
+    else:
+        open_archive = lambda: tarfile.open(fname, 'r')
+        with open_archive() as fp:
+            members = fp.getmembers()
+            # Directories, links and other special members go first
+            for m in members:
+                if not m.isfile():
+                    fp.extract(m, dest)
+        files = [m for m in members if m.isfile()]
+        names = [m.name for m in files]
+    parents = {os.path.join(dest, *[p for p in name.split('/')
+                                    if p not in ('', '.', '..')][:-1])
+               for name in names}
+
+    def extract_chunk(chunk):
+        with open_archive() as fp:
+            for m in chunk:
+                fp.extract(m, dest)
+
+    _map_chunks(extract_chunk, files, max_workers, parents)
+
+
+def _merge_into(src, dst):
+    """Move the tree at `src` to `dst`, renaming whole directories if new."""
+    if os.path.isdir(src) and os.path.isdir(dst):
+        for name in os.listdir(src):
+            _merge_into(os.path.join(src, name), os.path.join(dst, name))
+    else:
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        os.replace(src, dst)
+
+
+def _extracted(marker, base_dir):
+    """Return whether the extraction recorded in `marker` is still intact."""
+    # Deleting an extracted folder makes the archive extracted again
+    try:
+        with open(marker) as f:
+            names = json.load(f)['names']
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    return all(os.path.exists(os.path.join(base_dir, name))
+               for name in names)
+
+
+def _extract_once(fname, ext, base_dir):
+    """Extract `fname` into `base_dir` unless this content was extracted."""
+    marker = os.path.join(base_dir, '.extracted', file_sha1(fname))
+    if _extracted(marker, base_dir):
+        return
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with _file_lock(marker + '.lock'):
+        if _extracted(marker, base_dir):
+            return  # Another worker finished the extraction meanwhile
+        # Unpack into a private directory first and rename it into place, so
+        # that readers never see a half-extracted tree
+        tmp_dir = tempfile.mkdtemp(prefix='.extract-', dir=base_dir)
+        try:
+            _extract_members(fname, ext, tmp_dir)
+            names = sorted(os.listdir(tmp_dir))
+            for name in names:
+                _merge_into(os.path.join(tmp_dir, name),
+                            os.path.join(base_dir, name))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        with open(marker + '.tmp', 'w') as f:
+            json.dump({'archive': os.path.basename(fname), 'names': names}, f)
+        os.replace(marker + '.tmp', marker)
+
+
 def download_extract(name, folder=None):
     """Download and extract a zip/tar file."""
     fname = download(name)
     base_dir = os.path.dirname(fname)
     data_dir, ext = os.path.splitext(fname)
-    if ext == '.zip':
-        fp = zipfile.ZipFile(fname, 'r')
-    elif ext in ('.tar', '.gz'):
-        fp = tarfile.open(fname, 'r')
-    else:
-        assert False, 'Only zip/tar files can be extracted.'
-    fp.extractall(base_dir)
+    assert ext in ('.zip', '.tar', '.gz'), \
+        'Only zip/tar files can be extracted.'
+    _extract_once(fname, ext, base_dir)
     return os.path.join(base_dir, folder) if folder else data_dir
 
 
-def download_all():
+def download_all(cache_dir=os.path.join('..', 'data'), max_workers=8):
     """Download all files in the DATA_HUB."""
-    for name in DATA_HUB:
-        download(name)
+    names = list(DATA_HUB)
+    with d2l.requests.Session() as session:
+        # Let every worker thread keep its own pooled connection
+        adapter = d2l.requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            fnames = executor.map(
+                lambda name: download(name, cache_dir, session), names)
+            return dict(zip(names, fnames))
 
 
 # Defined in file: ./chapter_multilayer-perceptrons/kaggle-house-price.md
@@ -542,8 +741,12 @@ class Vocab:
             tokens = []
         if reserved_tokens is None:
             reserved_tokens = []
-        # Sort according to frequencies
-        counter = count_corpus(tokens)
+        # Sort according to frequencies. A `collections.Counter`, e.g. from
+        # `count_corpus_parallel`, is used as the token counts directly
+        if isinstance(tokens, collections.Counter):
+            counter = tokens
+        else:
+            counter = count_corpus(tokens)
         self._token_freqs = sorted(counter.items(), key=lambda x: x[1],
                                    reverse=True)
         # The index for the unknown token is 0
@@ -556,6 +759,9 @@ class Vocab:
             if token not in self.token_to_idx:
                 self.idx_to_token.append(token)
                 self.token_to_idx[token] = len(self.idx_to_token) - 1
+        # A token table that can be indexed with a whole array of indices
+        self._token_array = np.empty(len(self.idx_to_token), dtype=object)
+        self._token_array[:] = self.idx_to_token
 
     def __len__(self):
         return len(self.idx_to_token)
@@ -563,12 +769,38 @@ class Vocab:
     def __getitem__(self, tokens):
         if not isinstance(tokens, (list, tuple)):
             return self.token_to_idx.get(tokens, self.unk)
-        return [self.__getitem__(token) for token in tokens]
+        if len(tokens) > 0 and isinstance(tokens[0], (list, tuple)):
+            return [self.__getitem__(line) for line in tokens]
+        # Look up a flat list of tokens without a Python call per token
+        return list(
+            map(self.token_to_idx.get, tokens, itertools.repeat(self.unk)))
 
     def to_tokens(self, indices):
+        if isinstance(indices, np.ndarray):
+            return self._token_array[indices].tolist()
         if not isinstance(indices, (list, tuple)):
             return self.idx_to_token[indices]
-        return [self.idx_to_token[index] for index in indices]
+        indices = np.asarray(indices, dtype=np.int64)
+        return self._token_array[indices].tolist()
+
+    def encode(self, lines):
+        """Map token lists to flat int32 indices and int64 line offsets."""
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, lines), dtype=np.int64,
+                              count=len(lines)), out=offsets[1:])
+        tokens = itertools.chain.from_iterable(lines)
+        indices = np.fromiter(
+            map(self.token_to_idx.get, tokens, itertools.repeat(self.unk)),
+            dtype=np.int32, count=offsets[-1])
+        return indices, offsets
+
+    def decode(self, indices, offsets=None):
+        """Map the output of `encode` back to a list of token lists."""
+        tokens = self.to_tokens(np.asarray(indices))
+        if offsets is None:
+            return tokens
+        offsets = np.asarray(offsets).tolist()
+        return [tokens[i:j] for i, j in zip(offsets[:-1], offsets[1:])]
 
     @property
     def unk(self):  # Index for the unknown token
@@ -581,11 +813,56 @@ class Vocab:
 
 def count_corpus(tokens):
     """Count token frequencies."""
-    # Here `tokens` is a 1D list or 2D list
-    if len(tokens) == 0 or isinstance(tokens[0], list):
-        # Flatten a list of token lists into a list of tokens
-        tokens = [token for line in tokens for token in line]
-    return collections.Counter(tokens)
+    # Here `tokens` is a 1D list, a 2D list or an iterator over token lists;
+    # whether it is 2D is told by its first element, which is peeked at so
+    # that iterators can be consumed only once
+    tokens = iter(tokens)
+    first = next(tokens, None)
+    if first is None:
+        return collections.Counter()
+    if not isinstance(first, list):
+        return collections.Counter(itertools.chain([first], tokens))
+    # Count line by line instead of flattening the corpus into a new list
+    counter = collections.Counter(first)
+    for line in tokens:
+        counter.update(line)
+    return counter
+
+
+def merge_counts(counters, min_freq=0):
+    """Merge partial token counts, dropping tokens below `min_freq`."""
+    # Merging the counts of consecutive shards in order keeps every token at
+    # the position of its first occurrence, so sorting the merged counts by
+    # frequency gives the same order as counting the whole corpus at once
+    merged = collections.Counter()
+    for counter in counters:
+        merged.update(counter)
+    if min_freq > 1:
+        merged = collections.Counter(
+            {token: freq for token, freq in merged.items()
+             if freq >= min_freq})
+    return merged
+
+
+def count_corpus_parallel(lines, num_workers=None, chunk_size=10000,
+                          min_freq=0):
+    """Count token frequencies of an iterable of token lists in processes."""
+    num_workers = num_workers or os.cpu_count() or 1
+    lines = iter(lines)
+    chunks = iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+
+    def counts(executor):
+        # Only keep a few chunks in flight so that `lines` can be streamed
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(count_corpus, chunk))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        return merge_counts(counts(executor), min_freq)
 
 
 # Defined in file: ./chapter_recurrent-neural-networks/text-preprocessing.md
@@ -4,41 +4,65 @@
 
 # Defined in file: ./chapter_preface/index.md
 import collections
+import concurrent.futures
+import contextlib
+import functools
 import hashlib
+import importlib
+import itertools
+import json
 import math
 import os
+import queue
 import random
 import re
 import shutil
+import struct
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 import zipfile
 from collections import defaultdict
 
-import pandas as pd
-import requests
-from IPython import display
-from matplotlib import pyplot as plt
-
 d2l = sys.modules[__name__]
 
+# Heavy dependencies that most headless jobs never touch are imported on first
+# access of `d2l.<name>` instead of at module load
+_LAZY_MODULES = {
+    'display': 'IPython.display',
+    'pd': 'pandas',
+    'plt': 'matplotlib.pyplot',
+    'requests': 'requests'}
+
+
+def __getattr__(name):
+    """Import the module behind a lazy attribute on first access."""
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(_LAZY_MODULES[name])
+    globals()[name] = module
+    return module
+
 
 # Defined in file: ./chapter_preface/index.md
 import numpy as np
 import torch
-import torchvision
-from PIL import Image
 from torch import nn
 from torch.nn import functional as F
 from torch.utils import data
-from torchvision import transforms
+
+_LAZY_MODULES.update({
+    'Image': 'PIL.Image',
+    'torchvision': 'torchvision',
+    'transforms': 'torchvision.transforms'})
 
 
 # Defined in file: ./chapter_preliminaries/calculus.md
 def use_svg_display():
     """Use the svg format to display a plot in Jupyter."""
-    display.set_matplotlib_formats('svg')
+    d2l.display.set_matplotlib_formats('svg')
 
 
 # Defined in file: ./chapter_preliminaries/calculus.md
@@ -199,18 +223,18 @@ def get_dataloader_workers():
 # Defined in file: ./chapter_linear-networks/image-classification-dataset.md
 def load_data_fashion_mnist(batch_size, resize=None):
     """Download the Fashion-MNIST dataset and then load it into memory."""
-    trans = [transforms.ToTensor()]
+    trans = [d2l.transforms.ToTensor()]
     if resize:
-        trans.insert(0, transforms.Resize(resize))
-    trans = transforms.Compose(trans)
-    mnist_train = torchvision.datasets.FashionMNIST(root="../data",
-                                                    train=True,
-                                                    transform=trans,
-                                                    download=True)
-    mnist_test = torchvision.datasets.FashionMNIST(root="../data",
-                                                   train=False,
-                                                   transform=trans,
-                                                   download=True)
+        trans.insert(0, d2l.transforms.Resize(resize))
+    trans = d2l.transforms.Compose(trans)
+    mnist_train = d2l.torchvision.datasets.FashionMNIST(root="../data",
+                                                        train=True,
+                                                        transform=trans,
+                                                        download=True)
+    mnist_test = d2l.torchvision.datasets.FashionMNIST(root="../data",
+                                                       train=False,
+                                                       transform=trans,
+                                                       download=True)
     return (data.DataLoader(mnist_train, batch_size, shuffle=True,
                             num_workers=get_dataloader_workers()),
             data.DataLoader(mnist_test, batch_size, shuffle=False,
@@ -320,8 +344,8 @@ class Animator:
         for x, y, fmt in zip(self.X, self.Y, self.fmts):
             self.axes[0].plot(x, y, fmt)
         self.config_axes()
-        display.display(self.fig)
-        display.clear_output(wait=True)
+        d2l.display.display(self.fig)
+        d2l.display.clear_output(wait=True)
 
 
 # Defined in file: ./chapter_linear-networks/softmax-regression-scratch.md
@@ -369,49 +393,229 @@ DATA_URL = 'http://d2l-data.s3-accelerate.amazonaws.com/'
 
 
 # Defined in file: ./chapter_multilayer-perceptrons/kaggle-house-price.md
-def download(name, cache_dir=os.path.join('..', 'data')):
+def _hash_file(fname, sha1=None):
+    """Feed the contents of `fname` into a SHA-1 object."""
+    if sha1 is None:
+        sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(1048576)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1
+
+
+def _write_manifest(fname, sha1_hash):
+    """Record the size, mtime and SHA-1 of `fname` in a sidecar file."""
+    st = os.stat(fname)
+    tmp = f'{fname}.manifest.{os.getpid()}.{threading.get_ident()}'
+    with open(tmp, 'w') as f:
+        json.dump({'size': st.st_size, 'mtime': st.st_mtime_ns,
+                   'sha1': sha1_hash}, f)
+    os.replace(tmp, fname + '.manifest')
+
+
+def file_sha1(fname):
+    """Return the SHA-1 of `fname`, skipping the hash if nothing changed."""
+    try:
+        with open(fname + '.manifest', 'r') as f:
+            manifest = json.load(f)
+        st = os.stat(fname)
+        if (manifest['size'], manifest['mtime']) == (st.st_size,
+                                                     st.st_mtime_ns):
+            return manifest['sha1']
+    except (OSError, ValueError, KeyError):
+        pass
+    sha1_hash = _hash_file(fname).hexdigest()
+    _write_manifest(fname, sha1_hash)
+    return sha1_hash
+
+
+def download(name, cache_dir=os.path.join('..', 'data'), session=None):
     """Download a file inserted into DATA_HUB, return the local filename."""
     assert name in DATA_HUB, f"{name} does not exist in {DATA_HUB}."
     url, sha1_hash = DATA_HUB[name]
     os.makedirs(cache_dir, exist_ok=True)
     fname = os.path.join(cache_dir, url.split('/')[-1])
-    if os.path.exists(fname):
-        sha1 = hashlib.sha1()
-        with open(fname, 'rb') as f:
-            while True:
-                data = f.read(1048576)
-                if not data:
-                    break
-                sha1.update(data)
-        if sha1.hexdigest() == sha1_hash:
-            return fname  # Hit cache
+    if os.path.exists(fname) and file_sha1(fname) == sha1_hash:
+        return fname  # Hit cache
     print(f'Downloading {fname} from {url}...')
-    r = requests.get(url, stream=True, verify=True)
-    with open(fname, 'wb') as f:
-        f.write(r.content)
+    get = d2l.requests.get if session is None else session.get
+    part_fname = fname + '.part'
+    sha1 = _fetch_part(get, url, part_fname)
+    if sha1.hexdigest() != sha1_hash:
+        # A stale or corrupt partial file was resumed: start over once
+        os.remove(part_fname)
+        sha1 = _fetch_part(get, url, part_fname)
+        if sha1.hexdigest() != sha1_hash:
+            os.remove(part_fname)
+            raise ValueError(f'SHA-1 of {url} is {sha1.hexdigest()}, '
+                             f'expected {sha1_hash}.')
+    os.replace(part_fname, fname)
+    _write_manifest(fname, sha1_hash)
     return fname
 
 
+def _fetch_part(get, url, part_fname):
+    """Download `url` into `part_fname` and return its SHA-1 object."""
+    # Stream into the `.part` file, hashing while writing, and resume it with
+    # a range request if an earlier download was interrupted
+    sha1, pos = hashlib.sha1(), 0
+    if os.path.exists(part_fname):
+        sha1, pos = _hash_file(part_fname), os.path.getsize(part_fname)
+    headers = {'Range': f'bytes={pos}-'} if pos else {}
+    with get(url, stream=True, verify=True, headers=headers) as r:
+        # 416 means the partial file already holds the whole content
+        if not (pos and r.status_code == 416):
+            r.raise_for_status()
+            if r.status_code != 206:
+                # The server ignored the range request, so start over
+                sha1, pos = hashlib.sha1(), 0
+            with open(part_fname, 'ab' if pos else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1048576):
+                    f.write(chunk)
+                    sha1.update(chunk)
+    return sha1
+
+
 # Defined in file: ./chapter_multilayer-perceptrons/kaggle-house-price.md
+@contextlib.contextmanager
+def _file_lock(lock_fname):
+    """Hold an exclusive lock on `lock_fname` across threads and processes."""
+    with open(lock_fname, 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # `LK_LOCK` gives up after 10 seconds
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield  # The lock is released when `f` is closed
+
+
+def _map_chunks(fn, items, max_workers, dirs=()):
+    """Call `fn` on up to `max_workers` chunks of `items` in threads."""
+    # Create the directories up front so that workers do not race on them
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    chunk_size = max(1, math.ceil(len(items) / max_workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        list(executor.map(fn, [items[i:i + chunk_size]
+                               for i in range(0, len(items), chunk_size)]))
+
+
+def _extract_members(fname, ext, dest, max_workers=8):
+    """Extract an archive into `dest`, unpacking its files in parallel."""
+    if ext == '.gz':
+        # Members of a compressed tar can only be read in order
+        with tarfile.open(fname, 'r') as fp:
+            fp.extractall(dest)
+        return
+    if ext == '.zip':
+        open_archive = lambda: zipfile.ZipFile(fname, 'r')
+        with open_archive() as fp:
+            members = fp.infolist()
+        files = [m for m in members if not m.is_dir()]
+        names = [m.filename for m in members]
+    else:
+        open_archive = lambda: tarfile.open(fname, 'r')
+        with open_archive() as fp:
+            members = fp.getmembers()
+            # Directories, links and other special members go first
+            for m in members:
+                if not m.isfile():
+                    fp.extract(m, dest)
+        files = [m for m in members if m.isfile()]
+        names = [m.name for m in files]
+    parents = {os.path.join(dest, *[p for p in name.split('/')
+                                    if p not in ('', '.', '..')][:-1])
+               for name in names}
+
+    def extract_chunk(chunk):
+        with open_archive() as fp:
+            for m in chunk:
+                fp.extract(m, dest)
+
+    _map_chunks(extract_chunk, files, max_workers, parents)
+
+
+def _merge_into(src, dst):
+    """Move the tree at `src` to `dst`, renaming whole directories if new."""
+    if os.path.isdir(src) and os.path.isdir(dst):
+        for name in os.listdir(src):
+            _merge_into(os.path.join(src, name), os.path.join(dst, name))
+    else:
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        os.replace(src, dst)
+
+
+def _extracted(marker, base_dir):
+    """Return whether the extraction recorded in `marker` is still intact."""
+    # Deleting an extracted folder makes the archive extracted again
+    try:
+        with open(marker) as f:
+            names = json.load(f)['names']
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    return all(os.path.exists(os.path.join(base_dir, name))
+               for name in names)
+
+
+def _extract_once(fname, ext, base_dir):
+    """Extract `fname` into `base_dir` unless this content was extracted."""
+    marker = os.path.join(base_dir, '.extracted', file_sha1(fname))
+    if _extracted(marker, base_dir):
+        return
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with _file_lock(marker + '.lock'):
+        if _extracted(marker, base_dir):
+            return  # Another worker finished the extraction meanwhile
+        # Unpack into a private directory first and rename it into place, so
+        # that readers never see a half-extracted tree
+        tmp_dir = tempfile.mkdtemp(prefix='.extract-', dir=base_dir)
+        try:
+            _extract_members(fname, ext, tmp_dir)
+            names = sorted(os.listdir(tmp_dir))
+            for name in names:
+                _merge_into(os.path.join(tmp_dir, name),
+                            os.path.join(base_dir, name))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        with open(marker + '.tmp', 'w') as f:
+            json.dump({'archive': os.path.basename(fname), 'names': names}, f)
+        os.replace(marker + '.tmp', marker)
+
+
 def download_extract(name, folder=None):
     """Download and extract a zip/tar file."""
     fname = download(name)
     base_dir = os.path.dirname(fname)
     data_dir, ext = os.path.splitext(fname)
-    if ext == '.zip':
-        fp = zipfile.ZipFile(fname, 'r')
-    elif ext in ('.tar', '.gz'):
-        fp = tarfile.open(fname, 'r')
-    else:
-        assert False, 'Only zip/tar files can be extracted.'
-    fp.extractall(base_dir)
+    assert ext in ('.zip', '.tar', '.gz'), \
+        'Only zip/tar files can be extracted.'
+    _extract_once(fname, ext, base_dir)
     return os.path.join(base_dir, folder) if folder else data_dir
 
 
-def download_all():
+def download_all(cache_dir=os.path.join('..', 'data'), max_workers=8):
     """Download all files in the DATA_HUB."""
-    for name in DATA_HUB:
-        download(name)
+    names = list(DATA_HUB)
+    with d2l.requests.Session() as session:
+        # Let every worker thread keep its own pooled connection
+        adapter = d2l.requests.adapters.HTTPAdapter(
+            pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            fnames = executor.map(
+                lambda name: download(name, cache_dir, session), names)
+            return dict(zip(names, fnames))
 
 
 # Defined in file: ./chapter_multilayer-perceptrons/kaggle-house-price.md
@@ -571,8 +775,12 @@ class Vocab:
             tokens = []
         if reserved_tokens is None:
             reserved_tokens = []
-        # Sort according to frequencies
-        counter = count_corpus(tokens)
+        # Sort according to frequencies. A `collections.Counter`, e.g. from
+        # `count_corpus_parallel`, is used as the token counts directly
+        if isinstance(tokens, collections.Counter):
+            counter = tokens
+        else:
+            counter = count_corpus(tokens)
         self._token_freqs = sorted(counter.items(), key=lambda x: x[1],
                                    reverse=True)
         # The index for the unknown token is 0
@@ -585,6 +793,9 @@ class Vocab:
             if token not in self.token_to_idx:
                 self.idx_to_token.append(token)
                 self.token_to_idx[token] = len(self.idx_to_token) - 1
+        # A token table that can be indexed with a whole array of indices
+        self._token_array = np.empty(len(self.idx_to_token), dtype=object)
+        self._token_array[:] = self.idx_to_token
 
     def __len__(self):
         return len(self.idx_to_token)
@@ -592,12 +803,38 @@ class Vocab:
     def __getitem__(self, tokens):
         if not isinstance(tokens, (list, tuple)):
             return self.token_to_idx.get(tokens, self.unk)
-        return [self.__getitem__(token) for token in tokens]
+        if len(tokens) > 0 and isinstance(tokens[0], (list, tuple)):
+            return [self.__getitem__(line) for line in tokens]
+        # Look up a flat list of tokens without a Python call per token
+        return list(
+            map(self.token_to_idx.get, tokens, itertools.repeat(self.unk)))
 
     def to_tokens(self, indices):
+        if isinstance(indices, np.ndarray):
+            return self._token_array[indices].tolist()
         if not isinstance(indices, (list, tuple)):
             return self.idx_to_token[indices]
-        return [self.idx_to_token[index] for index in indices]
+        indices = np.asarray(indices, dtype=np.int64)
+        return self._token_array[indices].tolist()
+
+    def encode(self, lines):
+        """Map token lists to flat int32 indices and int64 line offsets."""
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, lines), dtype=np.int64,
+                              count=len(lines)), out=offsets[1:])
+        tokens = itertools.chain.from_iterable(lines)
+        indices = np.fromiter(
+            map(self.token_to_idx.get, tokens, itertools.repeat(self.unk)),
+            dtype=np.int32, count=offsets[-1])
+        return indices, offsets
+
+    def decode(self, indices, offsets=None):
+        """Map the output of `encode` back to a list of token lists."""
+        tokens = self.to_tokens(np.asarray(indices))
+        if offsets is None:
+            return tokens
+        offsets = np.asarray(offsets).tolist()
+        return [tokens[i:j] for i, j in zip(offsets[:-1], offsets[1:])]
 
     @property
     def unk(self):  # Index for the unknown token
@@ -610,54 +847,203 @@ class Vocab:
 
 def count_corpus(tokens):
     """Count token frequencies."""
-    # Here `tokens` is a 1D list or 2D list
-    if len(tokens) == 0 or isinstance(tokens[0], list):
-        # Flatten a list of token lists into a list of tokens
-        tokens = [token for line in tokens for token in line]
-    return collections.Counter(tokens)
+    # Here `tokens` is a 1D list, a 2D list or an iterator over token lists;
+    # whether it is 2D is told by its first element, which is peeked at so
+    # that iterators can be consumed only once
+    tokens = iter(tokens)
+    first = next(tokens, None)
+    if first is None:
+        return collections.Counter()
+    if not isinstance(first, list):
+        return collections.Counter(itertools.chain([first], tokens))
+    # Count line by line instead of flattening the corpus into a new list
+    counter = collections.Counter(first)
+    for line in tokens:
+        counter.update(line)
+    return counter
+
+
+def merge_counts(counters, min_freq=0):
+    """Merge partial token counts, dropping tokens below `min_freq`."""
+    # Merging the counts of consecutive shards in order keeps every token at
+    # the position of its first occurrence, so sorting the merged counts by
+    # frequency gives the same order as counting the whole corpus at once
+    merged = collections.Counter()
+    for counter in counters:
+        merged.update(counter)
+    if min_freq > 1:
+        merged = collections.Counter(
+            {token: freq for token, freq in merged.items()
+             if freq >= min_freq})
+    return merged
+
+
+def count_corpus_parallel(lines, num_workers=None, chunk_size=10000,
+                          min_freq=0):
+    """Count token frequencies of an iterable of token lists in processes."""
+    num_workers = num_workers or os.cpu_count() or 1
+    lines = iter(lines)
+    chunks = iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+
+    def counts(executor):
+        # Only keep a few chunks in flight so that `lines` can be streamed
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(count_corpus, chunk))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+        return merge_counts(counts(executor), min_freq)
 
 
 # Defined in file: ./chapter_recurrent-neural-networks/text-preprocessing.md
-def load_corpus_time_machine(max_tokens=-1):
+# Magic bytes, dtype string, number of tokens and vocabulary SHA-1 of a token
+# file, padded to 64 bytes so that the tokens that follow stay aligned
+_CORPUS_MAGIC = b'D2LTOKS1'
+_CORPUS_HEADER = struct.Struct('<8s8sQ20s20x')
+
+
+def _vocab_sha1(vocab):
+    """Return the SHA-1 digest of the index-to-token mapping of a vocab."""
+    sha1 = hashlib.sha1()
+    for token in vocab.idx_to_token:
+        sha1.update(str(token).encode('utf-8'))
+        sha1.update(b'\0')
+    return sha1.digest()
+
+
+def _read_corpus_header(fname):
+    """Return the dtype, length and vocab SHA-1 of a token file, or None."""
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'rb') as f:
+        header = f.read(_CORPUS_HEADER.size)
+    if len(header) < _CORPUS_HEADER.size or \
+            not header.startswith(_CORPUS_MAGIC):
+        return None
+    _, dtype, num_tokens, sha1 = _CORPUS_HEADER.unpack(header)
+    return np.dtype(dtype.rstrip(b'\0').decode()), num_tokens, sha1
+
+
+def save_corpus(corpus, vocab, fname, dtype=None, chunk_size=1 << 20):
+    """Write token indices to a memory-mappable file tagged with the vocab."""
+    if dtype is None:
+        dtype = np.uint16 if len(vocab) <= 1 << 16 else np.int32
+    dtype = np.dtype(dtype).newbyteorder('<')
+    assert dtype in (np.uint16, np.int32), 'Tokens are uint16 or int32.'
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    if isinstance(corpus, np.ndarray):
+        chunks = (corpus[i:i + chunk_size]
+                  for i in range(0, len(corpus), chunk_size))
+    else:
+        # Stream fixed-size chunks so that `corpus` may be a generator over
+        # a corpus that does not fit in memory
+        corpus = iter(corpus)
+        chunks = itertools.takewhile(len, (
+            np.fromiter(itertools.islice(corpus, chunk_size), dtype)
+            for _ in itertools.count()))
+    num_tokens = 0
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname) or '.',
+                                     prefix='.corpus-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.seek(_CORPUS_HEADER.size)
+            for chunk in chunks:
+                chunk.astype(dtype, copy=False).tofile(f)
+                num_tokens += len(chunk)
+            f.seek(0)
+            f.write(_CORPUS_HEADER.pack(_CORPUS_MAGIC, dtype.str.encode(),
+                                        num_tokens, _vocab_sha1(vocab)))
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+    return fname
+
+
+def _map_readonly(fname, dtype, shape=None, offset=0):
+    """Memory-map a file as an array that readers share the pages of."""
+    # Copy-on-write keeps the array writable for `torch.from_numpy` while
+    # all readers share the pages of the file
+    return np.memmap(fname, dtype, mode='c', offset=offset, shape=shape)
+
+
+def load_corpus(fname, vocab=None):
+    """Memory-map the token indices of a file written by `save_corpus`."""
+    header = _read_corpus_header(fname)
+    assert header is not None, f'{fname} is not a token file.'
+    dtype, num_tokens, sha1 = header
+    if vocab is not None:
+        assert sha1 == _vocab_sha1(vocab), \
+            f'{fname} was written with a different vocabulary.'
+    if num_tokens == 0:
+        return np.empty(0, dtype)
+    return _map_readonly(fname, dtype, (num_tokens,), _CORPUS_HEADER.size)
+
+
+def load_corpus_time_machine(max_tokens=-1, corpus_file=None):
     """Return token indices and the vocabulary of the time machine dataset."""
     lines = read_time_machine()
     tokens = tokenize(lines, 'char')
     vocab = Vocab(tokens)
     # Since each text line in the time machine dataset is not necessarily a
     # sentence or a paragraph, flatten all the text lines into a single list
-    corpus = [vocab[token] for line in tokens for token in line]
+    if corpus_file is None:
+        corpus = vocab.encode(tokens)[0].tolist()
+    else:
+        header = _read_corpus_header(corpus_file)
+        if header is None or header[2] != _vocab_sha1(vocab):
+            save_corpus(vocab.encode(tokens)[0], vocab, corpus_file)
+        corpus = load_corpus(corpus_file, vocab)
     if max_tokens > 0:
         corpus = corpus[:max_tokens]
     return corpus, vocab
 
 
 # Defined in file: ./chapter_recurrent-neural-networks/language-models-and-dataset.md
-def seq_data_iter_random(corpus, batch_size, num_steps):
+def _token_tensor(X):
+    """Return a minibatch of token indices as an int64 tensor."""
+    if isinstance(X, np.ndarray):
+        # `X` is a view into the (memory-mapped) corpus: only the minibatch
+        # itself is copied when widening to the indices `one_hot` expects
+        return torch.from_numpy(X.astype(np.int64))
+    return X if torch.is_tensor(X) else d2l.tensor(X)
+
+
+def seq_data_iter_random(corpus, batch_size, num_steps, pin_memory=False):
     """Generate a minibatch of subsequences using random sampling."""
     # Start with a random offset (inclusive of `num_steps - 1`) to partition a
     # sequence
-    corpus = corpus[random.randint(0, num_steps - 1):]
+    offset = random.randint(0, num_steps - 1)
     # Subtract 1 since we need to account for labels
-    num_subseqs = (len(corpus) - 1) // num_steps
+    num_subseqs = (len(corpus) - offset - 1) // num_steps
     # The starting indices for subsequences of length `num_steps`
     initial_indices = list(range(0, num_subseqs * num_steps, num_steps))
     # In random sampling, the subsequences from two adjacent random
     # minibatches during iteration are not necessarily adjacent on the
     # original sequence
     random.shuffle(initial_indices)
-
-    def data(pos):
-        # Return a sequence of length `num_steps` starting from `pos`
-        return corpus[pos:pos + num_steps]
-
+    initial_indices = np.array(initial_indices, dtype=np.int64) + offset
+    if not isinstance(corpus, np.ndarray):
+        corpus = np.asarray(corpus)
+    # Each row holds a subsequence and the token after it, so that `X` and
+    # the labels `Y` (shifted by one) are gathered with a single indexing
+    steps = np.arange(num_steps + 1)
+    pin_memory = pin_memory and torch.cuda.is_available()
     num_batches = num_subseqs // batch_size
     for i in range(0, batch_size * num_batches, batch_size):
         # Here, `initial_indices` contains randomized starting indices for
         # subsequences
-        initial_indices_per_batch = initial_indices[i:i + batch_size]
-        X = [data(j) for j in initial_indices_per_batch]
-        Y = [data(j + 1) for j in initial_indices_per_batch]
-        yield d2l.tensor(X), d2l.tensor(Y)
+        indices = initial_indices[i:i + batch_size, None] + steps
+        # Every minibatch gets its own tensor, so that batches held by the
+        # consumer (e.g., a `Prefetcher`) are never overwritten
+        block = torch.from_numpy(corpus[indices].astype(np.int64, copy=False))
+        if pin_memory:
+            block = block.pin_memory()
+        yield block[:, :-1], block[:, 1:]
 
 
 # Defined in file: ./chapter_recurrent-neural-networks/language-models-and-dataset.md
@@ -666,37 +1052,127 @@ def seq_data_iter_sequential(corpus, batch_size, num_steps):
     # Start with a random offset to partition a sequence
     offset = random.randint(0, num_steps)
     num_tokens = ((len(corpus) - offset - 1) // batch_size) * batch_size
-    Xs = d2l.tensor(corpus[offset:offset + num_tokens])
-    Ys = d2l.tensor(corpus[offset + 1:offset + 1 + num_tokens])
+    Xs = corpus[offset:offset + num_tokens]
+    Ys = corpus[offset + 1:offset + 1 + num_tokens]
+    if not isinstance(corpus, np.ndarray):
+        Xs, Ys = d2l.tensor(Xs), d2l.tensor(Ys)
     Xs, Ys = Xs.reshape(batch_size, -1), Ys.reshape(batch_size, -1)
     num_batches = Xs.shape[1] // num_steps
     for i in range(0, num_steps * num_batches, num_steps):
         X = Xs[:, i:i + num_steps]
         Y = Ys[:, i:i + num_steps]
-        yield X, Y
+        yield _token_tensor(X), _token_tensor(Y)
+
+
+# Defined in file: ./chapter_recurrent-neural-networks/language-models-and-dataset.md
+class Prefetcher:
+    """Iterate over `data_iter` in a background thread with a bounded queue."""
+    _END = object()
+
+    def __init__(self, data_iter, depth=2):
+        self.queue = queue.Queue(depth)
+        self.stop = threading.Event()
+        # Seconds spent waiting for a batch: when it stays near zero the
+        # consumer, not the loader, is the bottleneck
+        self.wait_time, self.done = 0.0, False
+        # The thread only holds the queue and the event, not `self`, so that
+        # an abandoned prefetcher is collected and `__del__` stops the thread
+        self.thread = threading.Thread(
+            target=self._produce, args=(data_iter, self.queue, self.stop),
+            daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _put(q, stop, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _produce(data_iter, q, stop):
+        put = Prefetcher._put
+        try:
+            for batch in data_iter:
+                if not put(q, stop, (True, batch)):
+                    return
+        except BaseException as e:
+            put(q, stop, (False, e))
+            return
+        put(q, stop, (True, Prefetcher._END))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        start = time.perf_counter()
+        ok, item = self.queue.get()
+        self.wait_time += time.perf_counter() - start
+        if not ok or item is self._END:
+            self.close()
+            if not ok:
+                raise item
+            raise StopIteration
+        return item
+
+    def close(self):
+        """Stop the background thread and drop the batches it prepared."""
+        self.done = True
+        self.stop.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+    def __del__(self):
+        self.close()
 
 
 # Defined in file: ./chapter_recurrent-neural-networks/language-models-and-dataset.md
 class SeqDataLoader:
     """An iterator to load sequence data."""
-    def __init__(self, batch_size, num_steps, use_random_iter, max_tokens):
+    def __init__(self, batch_size, num_steps, use_random_iter, max_tokens,
+                 corpus_file=None, prefetch=0):
         if use_random_iter:
             self.data_iter_fn = d2l.seq_data_iter_random
         else:
             self.data_iter_fn = d2l.seq_data_iter_sequential
-        self.corpus, self.vocab = d2l.load_corpus_time_machine(max_tokens)
+        self.corpus, self.vocab = d2l.load_corpus_time_machine(
+            max_tokens, corpus_file)
         self.batch_size, self.num_steps = batch_size, num_steps
+        # With `prefetch > 0`, batches are built in a background thread that
+        # keeps up to `prefetch` of them ready
+        self.prefetch, self.prefetcher = prefetch, None
+
+    @property
+    def wait_time(self):
+        """Seconds the last epoch spent waiting for prefetched batches."""
+        return self.prefetcher.wait_time if self.prefetcher else 0.0
 
     def __iter__(self):
-        return self.data_iter_fn(self.corpus, self.batch_size, self.num_steps)
+        data_iter = self.data_iter_fn(self.corpus, self.batch_size,
+                                      self.num_steps)
+        if self.prefetch <= 0:
+            return data_iter
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        self.prefetcher = d2l.Prefetcher(data_iter, self.prefetch)
+        return self.prefetcher
 
 
 # Defined in file: ./chapter_recurrent-neural-networks/language-models-and-dataset.md
 def load_data_time_machine(batch_size, num_steps, use_random_iter=False,
-                           max_tokens=10000):
+                           max_tokens=10000, corpus_file=None, prefetch=0):
     """Return the iterator and the vocabulary of the time machine dataset."""
     data_iter = SeqDataLoader(batch_size, num_steps, use_random_iter,
-                              max_tokens)
+                              max_tokens, corpus_file, prefetch)
     return data_iter, data_iter.vocab
 
 
@@ -913,20 +1389,82 @@ def truncate_pad(line, num_steps, padding_token):
     return line + [padding_token] * (num_steps - len(line))  # Pad
 
 
+def truncate_pad_encoded(indices, offsets, num_steps, padding_token):
+    """Truncate or pad every line of `Vocab.encode` output at once."""
+    lengths = np.minimum(np.diff(offsets), num_steps)
+    array = np.full((len(lengths), num_steps), padding_token,
+                    dtype=indices.dtype)
+    # Row and column of every token that survives truncation
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths,
+                                            lengths)
+    array[rows, cols] = indices[offsets[rows] + cols]
+    return array
+
+
 # Defined in file: ./chapter_recurrent-modern/machine-translation-and-dataset.md
 def build_array_nmt(lines, vocab, num_steps):
     """Transform text sequences of machine translation into minibatches."""
-    lines = [vocab[l] for l in lines]
-    lines = [l + [vocab['<eos>']] for l in lines]
-    array = d2l.tensor([
-        truncate_pad(l, num_steps, vocab['<pad>']) for l in lines])
+    indices, offsets = vocab.encode(lines)
+    # Append '<eos>' to every line
+    indices = np.insert(indices, offsets[1:], vocab['<eos>'])
+    offsets = offsets + np.arange(len(offsets))
+    array = torch.from_numpy(
+        truncate_pad_encoded(indices, offsets, num_steps,
+                             vocab['<pad>'])).long()
     valid_len = d2l.reduce_sum(d2l.astype(array != vocab['<pad>'], d2l.int32),
                                1)
     return array, valid_len
 
 
 # Defined in file: ./chapter_recurrent-modern/machine-translation-and-dataset.md
-def load_data_nmt(batch_size, num_steps, num_examples=600):
+class TokenBucketSampler(data.Sampler):
+    """Sample minibatches of similar lengths holding `token_budget` tokens."""
+    def __init__(self, lengths, token_budget, shuffle=True):
+        self.lengths = torch.as_tensor(lengths)
+        self.token_budget, self.shuffle = token_budget, shuffle
+        # Examples are grouped in ascending order of length, so a minibatch
+        # padded to its last (longest) example costs `size * length` tokens.
+        # The sizes only depend on the sorted lengths, so they are the same
+        # in every epoch however ties are shuffled
+        self.batch_sizes, size = [], 0
+        for length in torch.sort(self.lengths)[0].tolist():
+            if size and (size + 1) * length > token_budget:
+                self.batch_sizes.append(size)
+                size = 0
+            size += 1
+        if size:
+            self.batch_sizes.append(size)
+
+    def __len__(self):
+        return len(self.batch_sizes)
+
+    def __iter__(self):
+        if self.shuffle:
+            # Shuffle before the stable sort to break ties between examples
+            # of the same length randomly
+            order = torch.randperm(len(self.lengths))
+            order = order[torch.sort(self.lengths[order], stable=True)[1]]
+        else:
+            order = torch.sort(self.lengths, stable=True)[1]
+        batches = torch.split(order, self.batch_sizes)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+
+def trim_nmt_batch(batch):
+    """Drop the padding columns shared by all sequences of a minibatch."""
+    # The mean loss over time steps of `MaskedSoftmaxCELoss` depends on the
+    # length of `Y`: pass it the original `num_steps` to keep it unchanged
+    X, X_valid_len, Y, Y_valid_len = batch
+    return (X[:, :int(X_valid_len.max())], X_valid_len,
+            Y[:, :int(Y_valid_len.max())], Y_valid_len)
+
+
+# Defined in file: ./chapter_recurrent-modern/machine-translation-and-dataset.md
+def load_data_nmt(batch_size, num_steps, num_examples=600, token_budget=None):
     """Return the iterator and the vocabularies of the translation dataset."""
     text = preprocess_nmt(read_data_nmt())
     source, target = tokenize_nmt(text, num_examples)
@@ -937,7 +1475,22 @@ def load_data_nmt(batch_size, num_steps, num_examples=600):
     src_array, src_valid_len = build_array_nmt(source, src_vocab, num_steps)
     tgt_array, tgt_valid_len = build_array_nmt(target, tgt_vocab, num_steps)
     data_arrays = (src_array, src_valid_len, tgt_array, tgt_valid_len)
-    data_iter = d2l.load_array(data_arrays, batch_size)
+    if token_budget is None:
+        data_iter = d2l.load_array(data_arrays, batch_size)
+    else:
+        # Minibatches of up to `token_budget` (padded) tokens per side,
+        # each padded only to its own longest sequence: `batch_size` is
+        # ignored
+        sampler = TokenBucketSampler(
+            torch.maximum(src_valid_len, tgt_valid_len), token_budget)
+        # With `batch_size=None` every index list from the sampler fetches
+        # a whole minibatch from the tensors at once
+        data_iter = data.DataLoader(data.TensorDataset(*data_arrays),
+                                    batch_size=None, sampler=sampler,
+                                    collate_fn=trim_nmt_batch)
+        # Trimmed minibatches lose their length: `train_seq2seq` reads it
+        # here to keep averaging the loss of each sequence over `num_steps`
+        data_iter.num_steps = num_steps
     return data_iter, src_vocab, tgt_vocab
 
 
@@ -963,6 +1516,43 @@ class Decoder(nn.Module):
     def forward(self, X, state):
         raise NotImplementedError
 
+    # Batch axis of the tensors in the decoder state, for `reorder_state`:
+    # an int for all tensors, or a list, tuple or dict that mirrors the
+    # state, e.g., 1 for the RNN state of shape (`num_layers`, `batch_size`,
+    # `num_hiddens`) or (0, 1, 0) for the encoder outputs, RNN state and
+    # valid lengths of an RNN attention decoder
+    state_batch_axis = None
+
+    def reorder_state(self, state, indices, batch_axis=None):
+        """Select the batch rows `indices` of `state`, e.g., in beam search."""
+        if batch_axis is None:
+            batch_axis = self.state_batch_axis
+        return _reorder_state(state, indices, batch_axis)
+
+
+def _reorder_state(state, indices, batch_axis):
+    """Select the batch rows `indices` of `state` along `batch_axis`."""
+    # Objects such as caches reorder themselves
+    if hasattr(state, 'reorder'):
+        state.reorder(indices)
+        return state
+    if torch.is_tensor(state):
+        if not isinstance(batch_axis, int):
+            raise ValueError('The batch axis of the decoder state is unknown: '
+                             'set `state_batch_axis` of the decoder.')
+        return state.index_select(batch_axis, indices)
+    if isinstance(state, (list, tuple)):
+        axes = (batch_axis if isinstance(batch_axis, (list, tuple))
+                else [batch_axis] * len(state))
+        return type(state)(_reorder_state(s, indices, axis)
+                           for s, axis in zip(state, axes))
+    if isinstance(state, dict):
+        axes = (batch_axis if isinstance(batch_axis, dict)
+                else dict.fromkeys(state, batch_axis))
+        return {k: _reorder_state(v, indices, axes[k])
+                for k, v in state.items()}
+    return state
+
 
 # Defined in file: ./chapter_recurrent-modern/encoder-decoder.md
 class EncoderDecoder(nn.Module):
@@ -1018,12 +1608,21 @@ class MaskedSoftmaxCELoss(nn.CrossEntropyLoss):
     # `pred` shape: (`batch_size`, `num_steps`, `vocab_size`)
     # `label` shape: (`batch_size`, `num_steps`)
     # `valid_len` shape: (`batch_size`,)
+    def __init__(self, *args, num_steps=None, **kwargs):
+        super(MaskedSoftmaxCELoss, self).__init__(*args, **kwargs)
+        # The loss of each sequence is averaged over `num_steps` time steps
+        # when given, so that minibatches trimmed to their longest sequence
+        # (e.g., by `trim_nmt_batch`) keep the loss of untrimmed ones
+        self.num_steps = num_steps
+
     def forward(self, pred, label, valid_len):
         weights = torch.ones_like(label)
         weights = sequence_mask(weights, valid_len)
         self.reduction = 'none'
         unweighted_loss = super(MaskedSoftmaxCELoss,
                                 self).forward(pred.permute(0, 2, 1), label)
+        if self.num_steps is not None:
+            return (unweighted_loss * weights).sum(dim=1) / self.num_steps
         weighted_loss = (unweighted_loss * weights).mean(dim=1)
         return weighted_loss
 
@@ -1042,7 +1641,9 @@ def train_seq2seq(net, data_iter, lr, num_epochs, tgt_vocab, device):
     net.apply(xavier_init_weights)
     net.to(device)
     optimizer = torch.optim.Adam(net.parameters(), lr=lr)
-    loss = MaskedSoftmaxCELoss()
+    # Minibatches of `load_data_nmt` with a token budget are trimmed, so
+    # their loss is averaged over the `num_steps` they were padded to
+    loss = MaskedSoftmaxCELoss(num_steps=getattr(data_iter, 'num_steps', None))
     net.train()
     animator = d2l.Animator(xlabel='epoch', ylabel='loss',
                             xlim=[10, num_epochs])
@@ -1106,6 +1707,79 @@ def predict_seq2seq(net, src_sentence, src_vocab, tgt_vocab, num_steps,
     return ' '.join(tgt_vocab.to_tokens(output_seq)), attention_weight_seq
 
 
+# Defined in file: ./chapter_recurrent-modern/seq2seq.md
+def predict_seq2seq_batch(net, src_sentences, src_vocab, tgt_vocab, num_steps,
+                          device, beam_size=1, length_penalty=0.75,
+                          state_batch_axis=None):
+    """Predict for a batch of sentences with greedy or beam search."""
+    # Beam search reorders the decoder state along `state_batch_axis`, which
+    # defaults to the `state_batch_axis` declared by the decoder
+    net.eval()
+    batch_size, k = len(src_sentences), beam_size
+    lines = [s.lower().split(' ') for s in src_sentences]
+    # Valid lengths count '<eos>' and are clamped to `num_steps`, as in
+    # training
+    enc_X, enc_valid_len = d2l.build_array_nmt(lines, src_vocab, num_steps)
+    # Every sentence is decoded as `k` rows (hypotheses) of the batch
+    enc_X = enc_X.repeat_interleave(k, dim=0).to(device)
+    enc_valid_len = enc_valid_len.repeat_interleave(k).to(device)
+    with torch.no_grad():
+        enc_outputs = net.encoder(enc_X, enc_valid_len)
+        dec_state = net.decoder.init_state(enc_outputs, enc_valid_len)
+        eos = tgt_vocab['<eos>']
+        dec_X = torch.full((batch_size * k, 1), tgt_vocab['<bos>'],
+                           dtype=torch.long, device=device)
+        outputs = torch.full((batch_size * k, num_steps), eos,
+                             dtype=torch.long, device=device)
+        # Sum of log-probabilities of each hypothesis; all but one of the
+        # identical initial hypotheses of a sentence are disabled
+        scores = torch.full((batch_size, k), float('-inf'), device=device)
+        scores[:, 0] = 0
+        scores = scores.reshape(-1)
+        lengths = torch.zeros(batch_size * k, dtype=torch.long, device=device)
+        finished = torch.zeros(batch_size * k, dtype=torch.bool,
+                               device=device)
+        for step in range(num_steps):
+            Y, dec_state = net.decoder(dec_X, dec_state)
+            log_probs = F.log_softmax(Y[:, -1].float(), dim=-1)
+            # Finished hypotheses can only be extended by '<eos>' at no cost
+            eos_only = torch.full_like(log_probs[0], float('-inf'))
+            eos_only[eos] = 0
+            log_probs = torch.where(finished[:, None], eos_only, log_probs)
+            if k == 1:
+                log_probs, tokens = log_probs.max(dim=-1)
+                scores = scores + log_probs
+            else:
+                vocab_size = log_probs.shape[-1]
+                scores, candidates = (scores[:, None] + log_probs).reshape(
+                    batch_size, -1).topk(k, dim=-1)
+                scores = scores.reshape(-1)
+                # Row of the hypothesis that each new hypothesis extends
+                rows = (torch.arange(batch_size, device=device)[:, None] * k
+                        + candidates // vocab_size).reshape(-1)
+                tokens = (candidates % vocab_size).reshape(-1)
+                outputs, lengths = outputs[rows], lengths[rows]
+                finished = finished[rows]
+                dec_state = net.decoder.reorder_state(dec_state, rows,
+                                                      state_batch_axis)
+            outputs[:, step] = tokens
+            lengths = lengths + ~finished
+            finished = finished | (tokens == eos)
+            dec_X = tokens[:, None]
+            # A single synchronization per step for the whole batch
+            if finished.all():
+                break
+    # Hypotheses are ranked by their log-probability divided by
+    # `length ** length_penalty`
+    scores = scores / lengths.clamp(min=1).float() ** length_penalty
+    best = scores.reshape(batch_size, k).argmax(dim=1)
+    best = torch.arange(batch_size, device=device) * k + best
+    outputs, lengths = outputs[best].tolist(), lengths[best].tolist()
+    return [' '.join(tgt_vocab.to_tokens(
+                [token for token in output[:length] if token != eos]))
+            for output, length in zip(outputs, lengths)]
+
+
 # Defined in file: ./chapter_recurrent-modern/seq2seq.md
 def bleu(pred_seq, label_seq, k):
     """Compute the BLEU."""
@@ -1147,20 +1821,33 @@ def show_heatmaps(matrices, xlabel, ylabel, titles=None, figsize=(2.5, 2.5),
 # Defined in file: ./chapter_attention-mechanisms/attention-scoring-functions.md
 def masked_softmax(X, valid_lens):
     """Perform softmax operation by masking elements on the last axis."""
-    # `X`: 3D tensor, `valid_lens`: 1D or 2D tensor
+    # `X`: 3D tensor of shape (`batch_size`, no. of queries, no. of keys), or
+    # with more axes such as heads in between, `valid_lens`: 1D
+    # (`batch_size`,) or 2D (`batch_size`, no. of queries) tensor
     if valid_lens is None:
         return nn.functional.softmax(X, dim=-1)
     else:
-        shape = X.shape
-        if valid_lens.dim() == 1:
-            valid_lens = torch.repeat_interleave(valid_lens, shape[1])
-        else:
-            valid_lens = valid_lens.reshape(-1)
         # On the last axis, replace masked elements with a very large negative
-        # value, whose exponentiation outputs 0
-        X = d2l.sequence_mask(X.reshape(-1, shape[-1]), valid_lens,
-                              value=-1e6)
-        return nn.functional.softmax(X.reshape(shape), dim=-1)
+        # value, whose exponentiation outputs 0. The mask is broadcast from
+        # `valid_lens` over the other axes instead of being built for every
+        # row of `X`
+        X.masked_fill_(_key_mask(X.shape[-1], valid_lens, X.dim(), X.device),
+                       -1e6)
+        return nn.functional.softmax(X, dim=-1)
+
+
+def _key_mask(num_keys, valid_lens, ndim, device, start=0):
+    """Return which of the keys from position `start` on are masked."""
+    # Align the first axis of `valid_lens` with the batch axis and its other
+    # axes (if any) with those just before the key axis
+    if valid_lens.dim() == 1:
+        shape = valid_lens.shape + (1,) * (ndim - 1)
+    else:
+        shape = (valid_lens.shape[:1] + (1,) * (ndim - valid_lens.dim() - 1)
+                 + valid_lens.shape[1:] + (1,))
+    valid_lens = valid_lens.reshape(shape)
+    positions = torch.arange(start, start + num_keys, device=device)
+    return positions >= valid_lens
 
 
 # Defined in file: ./chapter_attention-mechanisms/attention-scoring-functions.md
@@ -1194,21 +1881,67 @@ class AdditiveAttention(nn.Module):
 # Defined in file: ./chapter_attention-mechanisms/attention-scoring-functions.md
 class DotProductAttention(nn.Module):
     """Scaled dot product attention."""
-    def __init__(self, dropout, **kwargs):
+    def __init__(self, dropout, chunk_size=None, **kwargs):
         super(DotProductAttention, self).__init__(**kwargs)
         self.dropout = nn.Dropout(dropout)
+        # When set, queries and keys are processed in tiles of `chunk_size`
+        # so that the attention weights are never materialized in full
+        self.chunk_size = chunk_size
 
     # Shape of `queries`: (`batch_size`, no. of queries, `d`)
     # Shape of `keys`: (`batch_size`, no. of key-value pairs, `d`)
     # Shape of `values`: (`batch_size`, no. of key-value pairs, value
     # dimension)
     # Shape of `valid_lens`: (`batch_size`,) or (`batch_size`, no. of queries)
+    # Extra axes, e.g., heads, may follow the batch axis of all three inputs
     def forward(self, queries, keys, values, valid_lens=None):
+        if self.chunk_size and keys.shape[-2] > self.chunk_size:
+            # Only the full path keeps the attention weights
+            self.attention_weights = None
+            return self._chunked_forward(queries, keys, values, valid_lens)
         d = queries.shape[-1]
         # Set `transpose_b=True` to swap the last two dimensions of `keys`
-        scores = torch.bmm(queries, keys.transpose(1, 2)) / math.sqrt(d)
+        scores = torch.matmul(queries, keys.transpose(-2, -1)) / math.sqrt(d)
         self.attention_weights = masked_softmax(scores, valid_lens)
-        return torch.bmm(self.dropout(self.attention_weights), values)
+        return torch.matmul(self.dropout(self.attention_weights), values)
+
+    def _chunked_forward(self, queries, keys, values, valid_lens):
+        d, size = queries.shape[-1], self.chunk_size
+        if valid_lens is not None:
+            valid_lens = valid_lens.reshape(valid_lens.shape[0], -1)
+        output = values.new_empty(queries.shape[:-1] + values.shape[-1:])
+        for i in range(0, queries.shape[-2], size):
+            Q = queries[..., i:i + size, :]
+            # Per-query valid lengths are sliced along with the queries
+            lens = valid_lens
+            if lens is not None and lens.shape[1] > 1:
+                lens = lens[:, i:i + size]
+            # Online softmax: keep the running maximum score `m`, the sum
+            # `l` of exponentiated scores and the weighted sum of values
+            # `acc`, rescaling both whenever the maximum grows
+            m = Q.new_full(Q.shape[:-1] + (1,), float('-inf'))
+            l = Q.new_zeros(Q.shape[:-1] + (1,))
+            acc = Q.new_zeros(Q.shape[:-1] + values.shape[-1:])
+            for j in range(0, keys.shape[-2], size):
+                scores = torch.matmul(
+                    Q, keys[..., j:j + size, :].transpose(-2, -1))
+                scores = scores / math.sqrt(d)
+                if lens is not None:
+                    # Same very large negative value as `masked_softmax`
+                    scores.masked_fill_(_key_mask(
+                        scores.shape[-1], lens, scores.dim(), scores.device,
+                        j), -1e6)
+                m_new = torch.maximum(m, scores.amax(dim=-1, keepdim=True))
+                scale = torch.exp(m - m_new)
+                P = torch.exp(scores - m_new)
+                l = l * scale + P.sum(dim=-1, keepdim=True)
+                # Dropping unnormalized weights is the same as dropping the
+                # normalized ones, since each row is divided by `l` in the end
+                acc = acc * scale + torch.matmul(
+                    self.dropout(P), values[..., j:j + size, :])
+                m = m_new
+            output[..., i:i + size, :] = acc / l
+        return output
 
 
 # Defined in file: ./chapter_attention-mechanisms/bahdanau-attention.md
@@ -1222,45 +1955,155 @@ class AttentionDecoder(d2l.Decoder):
         raise NotImplementedError
 
 
+# Defined in file: ./chapter_attention-mechanisms/multihead-attention.md
+class KVCache:
+    """Projected keys and values of the steps decoded so far."""
+    def __init__(self, capacity=16, static=False):
+        # Head-split buffers of shape (`batch_size`, `num_heads`, capacity,
+        # `num_hiddens` / `num_heads`), allocated by the first `update`
+        self.keys, self.values = None, None
+        self.capacity, self.length = capacity, 0
+        # A static cache (e.g., of encoder outputs in cross-attention) is
+        # filled once and reused as is in every later step
+        self.static = static
+
+    def _grow(self, length):
+        # Grow geometrically so that appending steps is amortized O(1)
+        self.capacity = max(2 * self.capacity, length)
+        for name in ('keys', 'values'):
+            old = getattr(self, name)
+            new = old.new_empty(old.shape[:2] + (self.capacity,)
+                                + old.shape[3:])
+            new[:, :, :self.length] = old[:, :, :self.length]
+            setattr(self, name, new)
+
+    def update(self, keys, values):
+        """Append the keys and values of new steps and return all of them."""
+        # Shape of `keys` and `values`: (`batch_size`, `num_heads`, no. of
+        # new steps, `num_hiddens` / `num_heads`)
+        if not (self.static and self.length):
+            length = self.length + keys.shape[2]
+            if self.keys is None:
+                self.capacity = max(self.capacity, length)
+                self.keys = keys.new_empty(
+                    keys.shape[:2] + (self.capacity,) + keys.shape[3:])
+                self.values = values.new_empty(
+                    values.shape[:2] + (self.capacity,) + values.shape[3:])
+            elif length > self.capacity:
+                self._grow(length)
+            self.keys[:, :, self.length:length] = keys
+            self.values[:, :, self.length:length] = values
+            self.length = length
+        return (self.keys[:, :, :self.length],
+                self.values[:, :, :self.length])
+
+    def reorder(self, indices):
+        """Select the batch rows `indices`, e.g., in beam search."""
+        if self.keys is None:
+            return
+        if len(indices) == self.keys.shape[0]:
+            # Indexing returns a copy, so rows can be overwritten in place
+            length = self.length
+            self.keys[:, :, :length] = self.keys[indices, :, :length]
+            self.values[:, :, :length] = self.values[indices, :, :length]
+        else:
+            self.keys = self.keys.index_select(0, indices)
+            self.values = self.values.index_select(0, indices)
+
+
 # Defined in file: ./chapter_attention-mechanisms/multihead-attention.md
 class MultiHeadAttention(nn.Module):
     """Multi-head attention."""
     def __init__(self, key_size, query_size, value_size, num_hiddens,
-                 num_heads, dropout, bias=False, **kwargs):
+                 num_heads, dropout, bias=False, fused_qkv=False,
+                 chunk_size=None, **kwargs):
         super(MultiHeadAttention, self).__init__(**kwargs)
         self.num_heads = num_heads
-        self.attention = d2l.DotProductAttention(dropout)
-        self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
-        self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
-        self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
+        # `chunk_size` enables the chunked path of `DotProductAttention` for
+        # long sequences
+        self.attention = d2l.DotProductAttention(dropout,
+                                                 chunk_size=chunk_size)
+        # With `fused_qkv`, self-attention projects queries, keys, and values
+        # with a single matrix multiplication
+        self.fused_qkv = fused_qkv
+        if fused_qkv:
+            assert key_size == query_size == value_size, \
+                'A fused projection needs equal query, key and value sizes.'
+            self.W_qkv = nn.Linear(query_size, 3 * num_hiddens, bias=bias)
+        else:
+            self.W_q = nn.Linear(query_size, num_hiddens, bias=bias)
+            self.W_k = nn.Linear(key_size, num_hiddens, bias=bias)
+            self.W_v = nn.Linear(value_size, num_hiddens, bias=bias)
         self.W_o = nn.Linear(num_hiddens, num_hiddens, bias=bias)
 
-    def forward(self, queries, keys, values, valid_lens):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept parameters saved with either layout of the projections
+        for param in ('weight', 'bias'):
+            separate = [f'{prefix}W_{name}.{param}' for name in 'qkv']
+            fused = f'{prefix}W_qkv.{param}'
+            if self.fused_qkv and all(key in state_dict for key in separate):
+                state_dict[fused] = torch.cat(
+                    [state_dict.pop(key) for key in separate])
+            elif not self.fused_qkv and fused in state_dict:
+                for key, value in zip(separate,
+                                      state_dict.pop(fused).chunk(3)):
+                    state_dict[key] = value
+        super(MultiHeadAttention, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+    def _project(self, X, i):
+        # Apply the projection of queries (`i` = 0), keys (1), or values (2)
+        if not self.fused_qkv:
+            return (self.W_q, self.W_k, self.W_v)[i](X)
+        weight = self.W_qkv.weight.chunk(3)[i]
+        bias = None if self.W_qkv.bias is None else self.W_qkv.bias.chunk(3)[i]
+        return F.linear(X, weight, bias)
+
+    def _split_heads(self, X):
+        # Shape of input `X`:
+        # (`batch_size`, no. of queries or key-value pairs, `num_hiddens`).
+        # Shape of output `X`, a view of the input:
+        # (`batch_size`, `num_heads`, no. of queries or key-value pairs,
+        # `num_hiddens` / `num_heads`)
+        return X.reshape(X.shape[0], X.shape[1], self.num_heads,
+                         -1).transpose(1, 2)
+
+    def forward(self, queries, keys, values, valid_lens, cache=None):
         # Shape of `queries`, `keys`, or `values`:
         # (`batch_size`, no. of queries or key-value pairs, `num_hiddens`)
         # Shape of `valid_lens`:
         # (`batch_size`,) or (`batch_size`, no. of queries)
-        # After transposing, shape of output `queries`, `keys`, or `values`:
-        # (`batch_size` * `num_heads`, no. of queries or key-value pairs,
+        # After splitting heads, shape of `queries`, `keys`, or `values`:
+        # (`batch_size`, `num_heads`, no. of queries or key-value pairs,
         # `num_hiddens` / `num_heads`)
-        queries = transpose_qkv(self.W_q(queries), self.num_heads)
-        keys = transpose_qkv(self.W_k(keys), self.num_heads)
-        values = transpose_qkv(self.W_v(values), self.num_heads)
-
-        if valid_lens is not None:
-            # On axis 0, copy the first item (scalar or vector) for
-            # `num_heads` times, then copy the next item, and so on
-            valid_lens = torch.repeat_interleave(valid_lens,
-                                                 repeats=self.num_heads,
-                                                 dim=0)
-
-        # Shape of `output`: (`batch_size` * `num_heads`, no. of queries,
+        batch_size, num_queries = queries.shape[0], queries.shape[1]
+        static = cache is not None and cache.static and cache.length
+        if self.fused_qkv and queries is keys and keys is values \
+                and not static:
+            # Queries, keys, and values are views of the fused projection
+            queries, keys, values = self.W_qkv(queries).reshape(
+                batch_size, num_queries, 3, self.num_heads, -1).permute(
+                    2, 0, 3, 1, 4).unbind(0)
+        else:
+            queries = self._split_heads(self._project(queries, 0))
+            if not static:
+                keys = self._split_heads(self._project(keys, 1))
+                values = self._split_heads(self._project(values, 2))
+        if cache is not None:
+            # In incremental decoding only the new steps are projected: they
+            # are appended to the cached keys and values. A filled static
+            # cache is returned as is
+            keys, values = cache.update(keys, values)
+
+        # `valid_lens` is broadcast over the heads. Shape of `output`:
+        # (`batch_size`, `num_heads`, no. of queries,
         # `num_hiddens` / `num_heads`)
         output = self.attention(queries, keys, values, valid_lens)
 
         # Shape of `output_concat`:
         # (`batch_size`, no. of queries, `num_hiddens`)
-        output_concat = transpose_output(output, self.num_heads)
+        output_concat = output.transpose(1, 2).reshape(batch_size,
+                                                       num_queries, -1)
         return self.W_o(output_concat)
 
 
@@ -1292,24 +2135,58 @@ def transpose_output(X, num_heads):
     return X.reshape(X.shape[0], X.shape[1], -1)
 
 
+# Defined in file: ./chapter_attention-mechanisms/self-attention-and-positional-encoding.md
+# Sinusoidal tables shared by all `PositionalEncoding` modules of the process,
+# keyed by (`num_hiddens`, dtype, device)
+_POSITIONAL_TABLES = {}
+_POSITIONAL_TABLES_LOCK = threading.Lock()
+
+
+def positional_encoding_table(num_steps, num_hiddens, dtype=torch.float32,
+                              device='cpu'):
+    """Return a view of the shared sinusoidal table for `num_steps` steps."""
+    key = (num_hiddens, dtype, torch.device(device))
+    P = _POSITIONAL_TABLES.get(key)
+    if P is None or P.shape[1] < num_steps:
+        with _POSITIONAL_TABLES_LOCK:
+            P = _POSITIONAL_TABLES.get(key)
+            if P is None or P.shape[1] < num_steps:
+                # Grow geometrically so that slowly increasing lengths, e.g.,
+                # in decoding, only rebuild the table a logarithmic number of
+                # times. The table is always computed in float32 on the CPU,
+                # so its rows do not depend on its length
+                max_len = max(num_steps, 2 * P.shape[1] if P is not None
+                              else 0)
+                P = d2l.zeros((1, max_len, num_hiddens))
+                X = d2l.arange(max_len, dtype=torch.float32).reshape(
+                    -1, 1) / torch.pow(
+                        10000,
+                        torch.arange(0, num_hiddens, 2, dtype=torch.float32)
+                        / num_hiddens)
+                P[:, :, 0::2] = torch.sin(X)
+                P[:, :, 1::2] = torch.cos(X)
+                P = P.to(dtype=dtype, device=device)
+                _POSITIONAL_TABLES[key] = P
+    return P[:, :num_steps, :]
+
+
 # Defined in file: ./chapter_attention-mechanisms/self-attention-and-positional-encoding.md
 class PositionalEncoding(nn.Module):
     """Positional encoding."""
     def __init__(self, num_hiddens, dropout, max_len=1000):
         super(PositionalEncoding, self).__init__()
         self.dropout = nn.Dropout(dropout)
-        # Create a long enough `P`
-        self.P = d2l.zeros((1, max_len, num_hiddens))
-        X = d2l.arange(max_len, dtype=torch.float32).reshape(
-            -1, 1) / torch.pow(
-                10000,
-                torch.arange(0, num_hiddens, 2, dtype=torch.float32) /
-                num_hiddens)
-        self.P[:, :, 0::2] = torch.sin(X)
-        self.P[:, :, 1::2] = torch.cos(X)
+        self.num_hiddens, self.max_len = num_hiddens, max_len
+
+    @property
+    def P(self):
+        # Looked up on access rather than stored, so that modules do not pin
+        # an old table after the shared one grows for longer sequences
+        return positional_encoding_table(self.max_len, self.num_hiddens)
 
     def forward(self, X):
-        X = X + self.P[:, :X.shape[1], :].to(X.device)
+        X = X + positional_encoding_table(X.shape[1], self.num_hiddens,
+                                          X.dtype, X.device)
         return self.dropout(X)
 
 
@@ -1344,11 +2221,12 @@ class EncoderBlock(nn.Module):
     """Transformer encoder block."""
     def __init__(self, key_size, query_size, value_size, num_hiddens,
                  norm_shape, ffn_num_input, ffn_num_hiddens, num_heads,
-                 dropout, use_bias=False, **kwargs):
+                 dropout, use_bias=False, chunk_size=None, **kwargs):
         super(EncoderBlock, self).__init__(**kwargs)
         self.attention = d2l.MultiHeadAttention(key_size, query_size,
                                                 value_size, num_hiddens,
-                                                num_heads, dropout, use_bias)
+                                                num_heads, dropout, use_bias,
+                                                chunk_size=chunk_size)
         self.addnorm1 = AddNorm(norm_shape, dropout)
         self.ffn = PositionWiseFFN(ffn_num_input, ffn_num_hiddens,
                                    num_hiddens)
@@ -1364,7 +2242,8 @@ class TransformerEncoder(d2l.Encoder):
     """Transformer encoder."""
     def __init__(self, vocab_size, key_size, query_size, value_size,
                  num_hiddens, norm_shape, ffn_num_input, ffn_num_hiddens,
-                 num_heads, num_layers, dropout, use_bias=False, **kwargs):
+                 num_heads, num_layers, dropout, use_bias=False,
+                 chunk_size=None, **kwargs):
         super(TransformerEncoder, self).__init__(**kwargs)
         self.num_hiddens = num_hiddens
         self.embedding = nn.Embedding(vocab_size, num_hiddens)
@@ -1375,7 +2254,8 @@ class TransformerEncoder(d2l.Encoder):
                 "block" + str(i),
                 EncoderBlock(key_size, query_size, value_size, num_hiddens,
                              norm_shape, ffn_num_input, ffn_num_hiddens,
-                             num_heads, dropout, use_bias))
+                             num_heads, dropout, use_bias,
+                             chunk_size=chunk_size))
 
     def forward(self, X, valid_lens, *args):
         # Since positional encoding values are between -1 and 1, the embedding
@@ -1645,7 +2525,48 @@ def bbox_to_rect(bbox, color):
 def multibox_prior(data, sizes, ratios):
     """Generate anchor boxes with different shapes centered on each pixel."""
     in_height, in_width = data.shape[-2:]
-    device, num_sizes, num_ratios = data.device, len(sizes), len(ratios)
+    return anchor_boxes(in_height, in_width, sizes, ratios, data.device)
+
+
+def anchor_boxes(in_height, in_width, sizes, ratios, device='cpu'):
+    """Return the cached anchor boxes of a feature map; do not modify them."""
+    # Anchor boxes only depend on the geometry of the feature map, so they are
+    # generated once per key and the same tensor is returned afterwards. It
+    # must not be an inference tensor, which training could not use
+    with torch.inference_mode(False):
+        return _anchor_boxes(int(in_height), int(in_width),
+                             tuple(float(s) for s in sizes),
+                             tuple(float(r) for r in ratios),
+                             torch.device(device))
+
+
+def multiscale_anchor_boxes(shapes, sizes, ratios, device='cpu'):
+    """Return the cached anchor boxes of several feature maps, concatenated."""
+    # Shape of the output: (1, total no. of anchor boxes, 4), with the anchor
+    # boxes of the i-th feature map of height and width `shapes[i]`, sizes
+    # `sizes[i]` and ratios `ratios[i]` in turn, like those of an SSD model
+    with torch.inference_mode(False):
+        return _multiscale_anchor_boxes(
+            tuple((int(h), int(w)) for h, w in shapes),
+            tuple(tuple(float(s) for s in scale_sizes)
+                  for scale_sizes in sizes),
+            tuple(tuple(float(r) for r in scale_ratios)
+                  for scale_ratios in ratios),
+            torch.device(device))
+
+
+@functools.lru_cache(maxsize=64)
+def _multiscale_anchor_boxes(shapes, sizes, ratios, device):
+    """Concatenate the anchor boxes of several feature maps."""
+    return torch.cat([_anchor_boxes(h, w, scale_sizes, scale_ratios, device)
+                      for (h, w), scale_sizes, scale_ratios in zip(
+                          shapes, sizes, ratios)], dim=1)
+
+
+@functools.lru_cache(maxsize=64)
+def _anchor_boxes(in_height, in_width, sizes, ratios, device):
+    """Generate the anchor boxes of a feature map."""
+    num_sizes, num_ratios = len(sizes), len(ratios)
     boxes_per_pixel = (num_sizes + num_ratios - 1)
     size_tensor = d2l.tensor(sizes, device=device)
     ratio_tensor = d2l.tensor(ratios, device=device)
@@ -1706,48 +2627,74 @@ def show_bboxes(axes, bboxes, labels=None, colors=None):
 # Defined in file: ./chapter_computer-vision/anchor.md
 def box_iou(boxes1, boxes2):
     """Compute pairwise IoU across two lists of anchor or bounding boxes."""
-    box_area = lambda boxes: ((boxes[:, 2] - boxes[:, 0]) *
-                              (boxes[:, 3] - boxes[:, 1]))
+    box_area = lambda boxes: ((boxes[..., 2] - boxes[..., 0]) *
+                              (boxes[..., 3] - boxes[..., 1]))
     # Shape of `boxes1`, `boxes2`, `areas1`, `areas2`: (no. of boxes1, 4),
-    # (no. of boxes2, 4), (no. of boxes1,), (no. of boxes2,)
+    # (no. of boxes2, 4), (no. of boxes1,), (no. of boxes2,). Leading batch
+    # axes of either list are broadcast
     areas1 = box_area(boxes1)
     areas2 = box_area(boxes2)
-    # Shape of `inter_upperlefts`, `inter_lowerrights`, `inters`: (no. of
-    # boxes1, no. of boxes2, 2)
-    inter_upperlefts = torch.max(boxes1[:, None, :2], boxes2[:, :2])
-    inter_lowerrights = torch.min(boxes1[:, None, 2:], boxes2[:, 2:])
-    inters = (inter_lowerrights - inter_upperlefts).clamp(min=0)
+    # Shape of `inter_widths`, `inter_heights`: (no. of boxes1, no. of
+    # boxes2). Each coordinate is handled as a contiguous tensor of its own,
+    # which is faster than broadcasting over a trailing axis of size 2
+    x1, y1, x2, y2 = boxes1.movedim(-1, 0).contiguous().unsqueeze(-1)
+    u1, v1, u2, v2 = boxes2.movedim(-1, 0).contiguous().unsqueeze(-2)
+    inter_widths = torch.min(x2, u2) - torch.max(x1, u1)
+    inter_heights = torch.min(y2, v2) - torch.max(y1, v1)
     # Shape of `inter_areas` and `union_areas`: (no. of boxes1, no. of boxes2)
-    inter_areas = inters[:, :, 0] * inters[:, :, 1]
-    union_areas = areas1[:, None] + areas2 - inter_areas
+    inter_areas = inter_widths.clamp_(min=0) * inter_heights.clamp_(min=0)
+    union_areas = areas1.unsqueeze(-1) + areas2.unsqueeze(-2) - inter_areas
     return inter_areas / union_areas
 
 
 # Defined in file: ./chapter_computer-vision/anchor.md
 def assign_anchor_to_bbox(ground_truth, anchors, device, iou_threshold=0.5):
     """Assign closest ground-truth bounding boxes to anchor boxes."""
-    num_anchors, num_gt_boxes = anchors.shape[0], ground_truth.shape[0]
-    # Element x_ij in the i-th row and j-th column is the IoU of the anchor
-    # box i and the ground-truth bounding box j
-    jaccard = box_iou(anchors, ground_truth)
-    # Initialize the tensor to hold the assigned ground-truth bounding box for
-    # each anchor
-    anchors_bbox_map = torch.full((num_anchors,), -1, dtype=torch.long,
-                                  device=device)
+    return assign_anchor_to_bbox_batch(ground_truth.unsqueeze(0), anchors,
+                                       iou_threshold)[0].to(device)
+
+
+def assign_anchor_to_bbox_batch(ground_truth, anchors, iou_threshold=0.5):
+    """Assign ground-truth bounding boxes to anchor boxes for a batch."""
+    # Shape of `ground_truth`: (`batch_size`, no. of ground-truth boxes, 4)
+    batch_size, num_gt_boxes = ground_truth.shape[:2]
+    device = anchors.device
+    # Element x_bji is the IoU of the ground-truth bounding box j of the b-th
+    # example and the anchor box i. Anchors are on the last axis since there
+    # are many more of them
+    jaccard = box_iou(ground_truth, anchors)
     # Assign ground-truth bounding boxes according to the threshold
     max_ious, indices = torch.max(jaccard, dim=1)
-    anc_i = torch.nonzero(max_ious >= 0.5).reshape(-1)
-    box_j = indices[max_ious >= 0.5]
-    anchors_bbox_map[anc_i] = box_j
-    col_discard = torch.full((num_anchors,), -1)
-    row_discard = torch.full((num_gt_boxes,), -1)
+    anchors_bbox_map = torch.where(max_ious >= iou_threshold, indices, -1)
+    if num_gt_boxes == 0:
+        return anchors_bbox_map
+    # Then, the largest IoU first, each ground-truth box takes the anchor box
+    # of the largest IoU that remains, and neither is considered again. Ties
+    # go to the first pair in the order of (anchor, ground truth). Rather
+    # than searching all pairs at every step, keep the best anchor of every
+    # ground-truth box and only update those whose anchor was taken
+    rows = torch.arange(batch_size, device=device)
+    gt_idx = torch.arange(num_gt_boxes, device=device)
+    best_ious, best_anchors = torch.max(jaccard, dim=2)
+    taken = torch.zeros_like(best_ious, dtype=torch.bool)
+    no_pair = anchors.shape[0] * num_gt_boxes
     for _ in range(num_gt_boxes):
-        max_idx = torch.argmax(jaccard)  # Find the largest IoU
-        box_idx = (max_idx % num_gt_boxes).long()
-        anc_idx = (max_idx / num_gt_boxes).long()
-        anchors_bbox_map[anc_idx] = box_idx
-        jaccard[:, box_idx] = col_discard
-        jaccard[anc_idx, :] = row_discard
+        is_max = best_ious == best_ious.max(dim=1, keepdim=True)[0]
+        pair_idx = torch.where(is_max, best_anchors * num_gt_boxes + gt_idx,
+                               no_pair).min(dim=1)[0]
+        box_idx = pair_idx % num_gt_boxes
+        anc_idx = torch.div(pair_idx, num_gt_boxes, rounding_mode='floor')
+        anchors_bbox_map[rows, anc_idx] = box_idx
+        # Discarded pairs get an IoU of -1: with fewer anchor boxes than
+        # ground-truth boxes, the last steps pick the first of them all
+        taken[rows, box_idx] = True
+        best_ious[rows, box_idx], best_anchors[rows, box_idx] = -1, 0
+        jaccard[rows, :, anc_idx] = -1
+        stale = (best_anchors == anc_idx[:, None]) & ~taken
+        if stale.any():
+            b, j = stale.nonzero(as_tuple=True)
+            best_ious[b, j], best_anchors[b, j] = torch.max(jaccard[b, j],
+                                                            dim=1)
     return anchors_bbox_map
 
 
@@ -1763,38 +2710,29 @@ def offset_boxes(anchors, assigned_bb, eps=1e-6):
 
 
 # Defined in file: ./chapter_computer-vision/anchor.md
-def multibox_target(anchors, labels):
+def multibox_target(anchors, labels, iou_threshold=0.5):
     """Label anchor boxes using ground-truth bounding boxes."""
     batch_size, anchors = labels.shape[0], anchors.squeeze(0)
-    batch_offset, batch_mask, batch_class_labels = [], [], []
-    device, num_anchors = anchors.device, anchors.shape[0]
-    for i in range(batch_size):
-        label = labels[i, :, :]
-        anchors_bbox_map = assign_anchor_to_bbox(label[:, 1:], anchors,
-                                                 device)
-        bbox_mask = ((anchors_bbox_map >= 0).float().unsqueeze(-1)).repeat(
-            1, 4)
-        # Initialize class labels and assigned bounding box coordinates with
-        # zeros
-        class_labels = torch.zeros(num_anchors, dtype=torch.long,
-                                   device=device)
-        assigned_bb = torch.zeros((num_anchors, 4), dtype=torch.float32,
-                                  device=device)
-        # Label classes of anchor boxes using their assigned ground-truth
-        # bounding boxes. If an anchor box is not assigned any, we label its
-        # class as background (the value remains zero)
-        indices_true = torch.nonzero(anchors_bbox_map >= 0)
-        bb_idx = anchors_bbox_map[indices_true]
-        class_labels[indices_true] = label[bb_idx, 0].long() + 1
-        assigned_bb[indices_true] = label[bb_idx, 1:]
-        # Offset transformation
-        offset = offset_boxes(anchors, assigned_bb) * bbox_mask
-        batch_offset.append(offset.reshape(-1))
-        batch_mask.append(bbox_mask.reshape(-1))
-        batch_class_labels.append(class_labels)
-    bbox_offset = torch.stack(batch_offset)
-    bbox_mask = torch.stack(batch_mask)
-    class_labels = torch.stack(batch_class_labels)
+    num_anchors = anchors.shape[0]
+    # Label all examples at once, shape of `anchors_bbox_map`:
+    # (`batch_size`, no. of anchors)
+    anchors_bbox_map = assign_anchor_to_bbox_batch(labels[:, :, 1:], anchors,
+                                                   iou_threshold)
+    is_assigned = anchors_bbox_map >= 0
+    bbox_mask = is_assigned.float().unsqueeze(-1).repeat(1, 1, 4)
+    # Label classes of anchor boxes using their assigned ground-truth
+    # bounding boxes. If an anchor box is not assigned any, we label its
+    # class as background (zero) and its offsets with zeros
+    assigned = labels.gather(1, anchors_bbox_map.clamp(min=0).unsqueeze(
+        -1).expand(-1, -1, labels.shape[-1]))
+    class_labels = torch.where(is_assigned, assigned[:, :, 0].long() + 1, 0)
+    # Offset transformation, only needed for the assigned anchor boxes
+    offset = torch.zeros((batch_size, num_anchors, 4), dtype=torch.float32,
+                         device=anchors.device)
+    b, i = torch.nonzero(is_assigned, as_tuple=True)
+    offset[b, i] = offset_boxes(anchors[i], assigned[b, i, 1:].float())
+    bbox_offset = offset.reshape(batch_size, -1)
+    bbox_mask = bbox_mask.reshape(batch_size, -1)
     return (bbox_offset, bbox_mask, class_labels)
 
 
@@ -1810,52 +2748,278 @@ def offset_inverse(anchors, offset_preds):
 
 
 # Defined in file: ./chapter_computer-vision/anchor.md
-def nms(boxes, scores, iou_threshold):
+def nms(boxes, scores, iou_threshold, mode='bitmask', top_k=None):
     """Sort confidence scores of predicted bounding boxes."""
+    keep = nms_mask(boxes.unsqueeze(0), scores.unsqueeze(0), iou_threshold,
+                    mode, top_k)[0]
+    B = torch.argsort(scores, dim=-1, descending=True)
+    return B[keep[B]]
+
+
+def batched_nms(boxes, scores, idxs, iou_threshold, mode='bitmask',
+                top_k=None):
+    """Apply non-maximum suppression within each group of boxes."""
+    # Boxes of different groups (e.g., images or classes) never suppress each
+    # other. Lay the groups out as rows, padded with invalid boxes
+    groups, inverse, counts = torch.unique(idxs, return_inverse=True,
+                                           return_counts=True)
+    num_groups = groups.numel()
+    num_boxes = int(counts.max()) if num_groups else 0
+    starts = counts.cumsum(0) - counts
+    slots = torch.empty_like(inverse)
+    slots[torch.argsort(inverse, stable=True)] = torch.arange(
+        inverse.numel(), device=idxs.device) - starts.repeat_interleave(counts)
+    layout_boxes = boxes.new_zeros((num_groups, num_boxes, 4))
+    layout_scores = scores.new_full((num_groups, num_boxes), float('-inf'))
+    valid = torch.zeros((num_groups, num_boxes), dtype=torch.bool,
+                        device=boxes.device)
+    layout_boxes[inverse, slots] = boxes
+    layout_scores[inverse, slots] = scores
+    valid[inverse, slots] = True
+    keep = nms_mask(layout_boxes, layout_scores, iou_threshold, mode, top_k,
+                    valid)[inverse, slots]
+    keep = torch.nonzero(keep).reshape(-1)
+    return keep[torch.argsort(scores[keep], descending=True, stable=True)]
+
+
+def nms_mask(boxes, scores, iou_threshold, mode='bitmask', top_k=None,
+             valid=None):
+    """Return which boxes of each row are kept by non-maximum suppression."""
+    # Shape of `boxes`: (no. of rows, no. of boxes, 4), shape of `scores`,
+    # `valid` and the output: (no. of rows, no. of boxes). Each row is
+    # suppressed on its own
+    if valid is None:
+        valid = torch.ones(scores.shape, dtype=torch.bool,
+                           device=scores.device)
+    if top_k is not None:
+        # Only the `top_k` boxes of the highest scores in each row take part
+        B = torch.argsort(scores, dim=-1, descending=True)
+        ranks = torch.empty_like(B).scatter_(
+            -1, B, torch.arange(B.shape[-1], device=B.device).expand_as(B))
+        valid = valid & (ranks < top_k)
+    return NMS_MODES[mode](boxes, scores, valid, iou_threshold)
+
+
+def _nms_loop(boxes, scores, valid, iou_threshold):
+    """Greedy NMS comparing each kept box with all the remaining ones."""
+    keep_mask = torch.zeros_like(valid)
+    for row in range(scores.shape[0]):
+        idx = torch.nonzero(valid[row]).reshape(-1)
+        row_boxes, row_scores = boxes[row, idx], scores[row, idx]
+        B = torch.argsort(row_scores, dim=-1, descending=True)
+        keep = []  # Indices of predicted bounding boxes that will be kept
+        while B.numel() > 0:
+            i = B[0]
+            keep.append(i)
+            if B.numel() == 1: break
+            iou = box_iou(row_boxes[i, :].reshape(-1, 4),
+                          row_boxes[B[1:], :].reshape(-1, 4)).reshape(-1)
+            inds = torch.nonzero(iou <= iou_threshold).reshape(-1)
+            B = B[inds + 1]
+        if keep:
+            keep_mask[row, idx[torch.stack(keep)]] = True
+    return keep_mask
+
+
+def _nms_bitmask(boxes, scores, valid, iou_threshold, block_size=128,
+                 max_pairs=1 << 18):
+    """Greedy NMS deciding a block of boxes of every row at a time."""
+    num_rows, num_boxes = scores.shape
+    device = boxes.device
+    # Visit the boxes of each row in the order of decreasing scores, the same
+    # order as `_nms_loop`
     B = torch.argsort(scores, dim=-1, descending=True)
-    keep = []  # Indices of predicted bounding boxes that will be kept
-    while B.numel() > 0:
-        i = B[0]
-        keep.append(i)
-        if B.numel() == 1: break
-        iou = box_iou(boxes[i, :].reshape(-1, 4),
-                      boxes[B[1:], :].reshape(-1, 4)).reshape(-1)
-        inds = torch.nonzero(iou <= iou_threshold).reshape(-1)
-        B = B[inds + 1]
-    return d2l.tensor(keep, device=boxes.device)
+    boxes = boxes.gather(1, B.unsqueeze(-1).expand(-1, -1, 4))
+    alive = valid.gather(1, B)
+    keep = torch.zeros_like(alive)
+    flat_boxes = boxes.reshape(-1, 4)
+    areas = ((flat_boxes[:, 2] - flat_boxes[:, 0]) *
+             (flat_boxes[:, 3] - flat_boxes[:, 1]))
+    index = _nms_sweep_index(boxes, alive, iou_threshold)
+    sweep = torch.argsort(index[0])
+    rows = torch.arange(num_rows, device=device).unsqueeze(-1)
+    later = torch.ones((block_size, block_size), dtype=torch.bool,
+                       device=device).triu(1)
+    while True:
+        # The first `block_size` boxes still alive in each row form a block
+        ranks = alive.cumsum(1)
+        row, pos = torch.nonzero(alive & (ranks <= block_size),
+                                 as_tuple=True)
+        if row.numel() == 0:
+            break
+        slot = ranks[row, pos] - 1
+        block = torch.zeros((num_rows, block_size), dtype=torch.long,
+                            device=device)
+        member = torch.zeros((num_rows, block_size), dtype=torch.bool,
+                             device=device)
+        block[row, slot], member[row, slot] = pos, True
+        alive[row, pos] = False
+        # Bitmask of which box of the block suppresses which later one. A box
+        # is kept if no kept box before it suppresses it: iterate until the
+        # solution of this triangular system stops changing
+        block_boxes = boxes[rows, block]
+        iou = box_iou(block_boxes, block_boxes)
+        suppress = ~(iou <= iou_threshold) & later & member.unsqueeze(1)
+        kept = member
+        while True:
+            new_kept = member & ~(suppress & kept.unsqueeze(-1)).any(1)
+            if torch.equal(new_kept, kept):
+                break
+            kept = new_kept
+        row, slot = torch.nonzero(kept, as_tuple=True)
+        pos = block[row, slot]
+        keep[row, pos] = True
+        _nms_sweep(flat_boxes, areas, alive.view(-1), index, sweep,
+                   row * num_boxes + pos, iou_threshold, max_pairs)
+    return torch.zeros_like(keep).scatter_(1, B, keep)
+
+
+def _nms_sweep_index(boxes, valid, iou_threshold):
+    """Return sort keys of boxes and the ranges of keys they may suppress."""
+    # Shape of `boxes`: (no. of rows, no. of boxes, 4). A box of key range
+    # (lo, hi), base b and bins from f to l may suppress the boxes whose keys
+    # are in (b + k * bin_stride + lo, b + k * bin_stride + hi) for k from f
+    # to l
+    num_rows, num_boxes = boxes.shape[:2]
+    rows = torch.arange(num_rows, dtype=torch.float64,
+                        device=boxes.device).unsqueeze(-1)
+    valid_boxes = boxes[valid]
+    widths = valid_boxes[:, 2] - valid_boxes[:, 0]
+    heights = valid_boxes[:, 3] - valid_boxes[:, 1]
+    if (iou_threshold < 0 or valid_boxes.numel() == 0
+            or not torch.isfinite(valid_boxes).all()
+            or (widths <= 0).any() or (heights <= 0).any()):
+        # Boxes of no area can have an IoU of NaN without overlapping: compare
+        # all the pairs of boxes in the same row
+        keys = rows.expand(num_rows, num_boxes).reshape(-1)
+        no_bins = torch.zeros_like(keys, dtype=torch.long)
+        return (keys, keys, no_bins, no_bins, torch.full_like(keys, -0.5),
+                torch.full_like(keys, 0.5), 0)
+    # The IoU of two boxes is at most that of their extents along either
+    # axis, so a box of width w can only suppress boxes of widths in
+    # (tw, w/t) whose left edges are in (x1 + (tw - w_max) / (1 + t),
+    # x2 - tw), and likewise along the y-axis. Boxes are sorted by their
+    # rows, then strips of their top edges, then their left edges, with
+    # coordinates shifted by multiples of strides larger than the spans of
+    # the boxes, so that the boxes a box may suppress lie in one range of
+    # keys per strip. The ranges are widened a little for rounding errors
+    t = iou_threshold
+    max_width, max_height = float(widths.max()), float(heights.max())
+    x_min, y_min = float(valid_boxes[:, 0].min()), float(
+        valid_boxes[:, 1].min())
+    x_span = float(valid_boxes[:, 2].max()) - x_min
+    y_span = float(valid_boxes[:, 3].max()) - y_min
+    bin_height = max(float(heights.median()) / 2, y_span / 256)
+    bin_stride = math.ceil(x_span + max_width) + 1
+    row_stride = bin_stride * (int(y_span / bin_height) + 1)
+    x1, y1, x2, y2 = boxes.double().reshape(-1, 4).unbind(-1)
+    bases = rows.expand(num_rows, num_boxes).reshape(-1) * row_stride
+    bins = ((y1 - y_min) / bin_height).floor_().clamp_(min=0).long()
+    keys = bases + bins * bin_stride + x1
+
+    def key_range(lo, hi, max_size, scale):
+        # Range of the lower edges of the boxes a box from `lo` to `hi` may
+        # suppress along one axis
+        size = hi - lo
+        max_sizes = (size / t).clamp(max=max_size) if t > 0 else max_size
+        margin = 1e-6 * scale
+        return (lo + (t * size - max_sizes) / (1 + t) - margin,
+                hi - t * size + margin)
+
+    lows, highs = key_range(x1, x2, max_width, bin_stride)
+    y_lows, y_highs = key_range(y1, y2, max_height, y_span + max_height)
+    first_bins = ((y_lows - y_min) / bin_height).floor_().clamp_(min=0)
+    last_bins = ((y_highs - y_min) / bin_height).floor_().clamp_(min=0)
+    return (keys, bases, first_bins.long(), last_bins.long(), lows, highs,
+            bin_stride)
+
+
+def _nms_sweep(boxes, areas, alive, index, sweep, kept, iou_threshold,
+               max_pairs):
+    """Remove the alive boxes that the kept boxes suppress."""
+    keys, bases, first_bins, last_bins, lows, highs, bin_stride = index
+    # Alive boxes sorted by keys; each kept box is compared with the ranges
+    # of them in its strips
+    cols = sweep[alive[sweep]]
+    if cols.numel() == 0 or kept.numel() == 0:
+        return
+    num_bins = (last_bins[kept] - first_bins[kept] + 1).clamp_(min=0)
+    kept = kept.repeat_interleave(num_bins)
+    bins = (first_bins[kept] + torch.arange(kept.numel(), device=kept.device)
+            - (num_bins.cumsum(0) - num_bins).repeat_interleave(num_bins))
+    offsets = bases[kept] + bins * bin_stride
+    col_keys = keys[cols]
+    starts = torch.searchsorted(col_keys, offsets + lows[kept])
+    counts = (torch.searchsorted(col_keys, offsets + highs[kept], right=True)
+              - starts).clamp_(min=0)
+    ends = counts.cumsum(0)
+    begin = 0
+    while begin < kept.numel():
+        # Compare at most `max_pairs` pairs (but at least one range) at once
+        first = int(ends[begin - 1]) if begin else 0
+        end = max(int(torch.searchsorted(ends, first + max_pairs,
+                                         right=True)), begin + 1)
+        n = counts[begin:end]
+        total = int(ends[end - 1]) - first
+        if total:
+            i = kept[begin:end].repeat_interleave(n)
+            j = cols[(starts[begin:end] - ends[begin:end] + n + first
+                      ).repeat_interleave(n) + torch.arange(
+                          total, device=cols.device)]
+            # The same operations as `box_iou` with kept boxes as `boxes1`
+            boxes1, boxes2 = boxes[i], boxes[j]
+            inter_widths = torch.min(boxes1[:, 2], boxes2[:, 2]) - torch.max(
+                boxes1[:, 0], boxes2[:, 0])
+            inter_heights = torch.min(boxes1[:, 3], boxes2[:, 3]) - torch.max(
+                boxes1[:, 1], boxes2[:, 1])
+            inter_areas = inter_widths.clamp_(min=0) * inter_heights.clamp_(
+                min=0)
+            union_areas = areas[i] + areas[j] - inter_areas
+            iou = inter_areas / union_areas
+            alive[j[~(iou <= iou_threshold)]] = False
+        begin = end
+
+
+NMS_MODES = {'loop': _nms_loop, 'bitmask': _nms_bitmask}
 
 
 # Defined in file: ./chapter_computer-vision/anchor.md
 def multibox_detection(cls_probs, offset_preds, anchors, nms_threshold=0.5,
-                       pos_threshold=0.009999999):
+                       pos_threshold=0.009999999, nms_mode='bitmask',
+                       pre_nms_top_k=None):
     """Predict bounding boxes using non-maximum suppression."""
     device, batch_size = cls_probs.device, cls_probs.shape[0]
     anchors = anchors.squeeze(0)
     num_classes, num_anchors = cls_probs.shape[1], cls_probs.shape[2]
-    out = []
-    for i in range(batch_size):
-        cls_prob, offset_pred = cls_probs[i], offset_preds[i].reshape(-1, 4)
-        conf, class_id = torch.max(cls_prob[1:], 0)
-        predicted_bb = offset_inverse(anchors, offset_pred)
-        keep = nms(predicted_bb, conf, nms_threshold)
-        # Find all non-`keep` indices and set the class to background
-        all_idx = torch.arange(num_anchors, dtype=torch.long, device=device)
-        combined = torch.cat((keep, all_idx))
-        uniques, counts = combined.unique(return_counts=True)
-        non_keep = uniques[counts == 1]
-        all_id_sorted = torch.cat((keep, non_keep))
-        class_id[non_keep] = -1
-        class_id = class_id[all_id_sorted]
-        conf, predicted_bb = conf[all_id_sorted], predicted_bb[all_id_sorted]
-        # Here `pos_threshold` is a threshold for positive (non-background)
-        # predictions
-        below_min_idx = (conf < pos_threshold)
-        class_id[below_min_idx] = -1
-        conf[below_min_idx] = 1 - conf[below_min_idx]
-        pred_info = torch.cat(
-            (class_id.unsqueeze(1), conf.unsqueeze(1), predicted_bb), dim=1)
-        out.append(pred_info)
-    return d2l.stack(out)
+    # All the examples are handled at once, shape of `conf` and `class_id`:
+    # (`batch_size`, no. of anchors)
+    conf, class_id = torch.max(cls_probs[:, 1:], 1)
+    predicted_bb = offset_inverse(
+        anchors.repeat(batch_size, 1), offset_preds.reshape(-1, 4)).reshape(
+            batch_size, num_anchors, 4)
+    keep = nms_mask(predicted_bb, conf, nms_threshold, nms_mode,
+                    pre_nms_top_k)
+    # Kept boxes come first in the order of decreasing confidence, followed by
+    # all non-`keep` boxes in the order of their indices, whose class is set
+    # to background
+    B = torch.argsort(conf, dim=-1, descending=True)
+    all_idx = torch.arange(num_anchors, dtype=torch.long,
+                           device=device).expand_as(B)
+    ranks = torch.empty_like(B).scatter_(1, B, all_idx)
+    all_id_sorted = torch.argsort(
+        torch.where(keep, ranks, num_anchors + all_idx), dim=1)
+    class_id[~keep] = -1
+    class_id = class_id.gather(1, all_id_sorted)
+    conf = conf.gather(1, all_id_sorted)
+    predicted_bb = predicted_bb.gather(
+        1, all_id_sorted.unsqueeze(-1).expand(-1, -1, 4))
+    # Here `pos_threshold` is a threshold for positive (non-background)
+    # predictions
+    below_min_idx = (conf < pos_threshold)
+    class_id[below_min_idx] = -1
+    conf[below_min_idx] = 1 - conf[below_min_idx]
+    return torch.cat(
+        (class_id.unsqueeze(-1), conf.unsqueeze(-1), predicted_bb), dim=-1)
 
 
 # Defined in file: ./chapter_computer-vision/object-detection-dataset.md
@@ -1865,33 +3029,236 @@ d2l.DATA_HUB['banana-detection'] = (
 
 
 # Defined in file: ./chapter_computer-vision/object-detection-dataset.md
-def read_data_bananas(is_train=True):
+def read_data_bananas(is_train=True, lazy=False, cache_size=0):
     """Read the banana detection dataset images and labels."""
     data_dir = d2l.download_extract('banana-detection')
     csv_fname = os.path.join(data_dir,
                              'bananas_train' if is_train else 'bananas_val',
                              'label.csv')
-    csv_data = pd.read_csv(csv_fname)
+    csv_data = d2l.pd.read_csv(csv_fname)
     csv_data = csv_data.set_index('img_name')
-    images, targets = [], []
+    paths, targets = [], []
     for img_name, target in csv_data.iterrows():
-        images.append(
-            torchvision.io.read_image(
-                os.path.join(data_dir,
-                             'bananas_train' if is_train else 'bananas_val',
-                             'images', f'{img_name}')))
+        paths.append(
+            os.path.join(data_dir,
+                         'bananas_train' if is_train else 'bananas_val',
+                         'images', f'{img_name}'))
         # Here `target` contains (class, upper-left x, upper-left y,
         # lower-right x, lower-right y), where all the images have the same
         # banana class (index 0)
         targets.append(list(target))
+    if lazy:
+        images = LazyImages(paths, cache_size=cache_size)
+    else:
+        images = [d2l.torchvision.io.read_image(path) for path in paths]
     return images, torch.tensor(targets).unsqueeze(1) / 256
 
 
+class LazyImages:
+    """A sequence of image files that are only decoded when indexed."""
+    def __init__(self, paths, mode=None, cache_size=0):
+        self.paths, self.mode, self.cache_size = list(paths), mode, cache_size
+        # Least recently used decoded (uint8) images, the latest last
+        self.cache = collections.OrderedDict()
+        self._shapes = None
+
+    @property
+    def shapes(self):
+        """Shapes (channels, height, width), read from the file headers."""
+        if self._shapes is None:
+            self._shapes = [self._read_shape(path) for path in self.paths]
+        return self._shapes
+
+    def _read_shape(self, path):
+        with d2l.Image.open(path) as img:
+            num_channels = {'RGB': 3, 'GRAY': 1}.get(
+                getattr(self.mode, 'name', None), len(img.getbands()))
+            return (num_channels, img.height, img.width)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple, slice)):
+            # A list of indices or a slice selects a subset of the images
+            paths = (self.paths[idx] if isinstance(idx, slice)
+                     else [self.paths[i] for i in idx])
+            subset = LazyImages(paths, self.mode, self.cache_size)
+            if self._shapes is not None:
+                subset._shapes = (self._shapes[idx] if isinstance(idx, slice)
+                                  else [self._shapes[i] for i in idx])
+            return subset
+        path = self.paths[idx]
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            return self.cache[path]
+        if self.mode is None:
+            img = d2l.torchvision.io.read_image(path)
+        else:
+            img = d2l.torchvision.io.read_image(path, self.mode)
+        if self.cache_size > 0:
+            self.cache[path] = img
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return img
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def _packed_shard_fname(fname, shard):
+    return f'{os.path.splitext(fname)[0]}-{shard:05d}.shard'
+
+
+def _encode_image(image, encoding, quality):
+    """Return the bytes to pack of an image (path or tensor) and its shape."""
+    if isinstance(image, str):
+        if (encoding == 'jpeg' and
+                image.lower().endswith(('.jpg', '.jpeg'))):
+            # JPEG files are packed as they are
+            with d2l.Image.open(image) as img:
+                shape = (len(img.getbands()), img.height, img.width)
+            with open(image, 'rb') as f:
+                return f.read(), shape
+        image = d2l.torchvision.io.read_image(image)
+    if encoding == 'jpeg':
+        data = d2l.torchvision.io.encode_jpeg(image, quality=quality)
+    else:
+        data = image.contiguous().view(-1)
+    return data.numpy().tobytes(), tuple(image.shape)
+
+
+def pack_images(images, fname, labels=None, classes=None, encoding='raw',
+                shard_bytes=1 << 30, quality=95):
+    """Write images and labels into shards of bytes with an offset index."""
+    # `images` are paths or uint8 tensors of shape (channels, height, width)
+    # (e.g., `LazyImages`). Each image is stored as raw uint8 values or as
+    # JPEG bytes in one of the files `<fname>-00000.shard`, ..., of at most
+    # `shard_bytes` bytes (unless an image is larger). Row i of the index is
+    # (shard, offset, no. of bytes, channels, height, width) of image i
+    assert encoding in ('raw', 'jpeg'), 'Images are packed raw or as JPEG.'
+    if isinstance(images, LazyImages) and images.mode is None:
+        images = images.paths
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    index = np.zeros((len(images), 6), dtype=np.int64)
+    tmp_fnames, f, offset = [], None, 0
+    try:
+        for i in range(len(images)):
+            data, shape = _encode_image(images[i], encoding, quality)
+            if f is None or (offset and offset + len(data) > shard_bytes):
+                if f is not None:
+                    f.close()
+                fd, tmp_fname = tempfile.mkstemp(
+                    dir=os.path.dirname(fname) or '.', prefix='.shard-')
+                tmp_fnames.append(tmp_fname)
+                f, offset = os.fdopen(fd, 'wb'), 0
+            f.write(data)
+            index[i] = (len(tmp_fnames) - 1, offset, len(data), *shape)
+            offset += len(data)
+        if f is not None:
+            f.close()
+        for shard, tmp_fname in enumerate(tmp_fnames):
+            os.replace(tmp_fname, _packed_shard_fname(fname, shard))
+    except BaseException:
+        if f is not None:
+            f.close()
+        for tmp_fname in tmp_fnames:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+        raise
+    packed = {'index': index, 'encoding': np.array(encoding)}
+    if labels is not None:
+        packed['labels'] = np.asarray(labels)
+    if classes is not None:
+        packed['classes'] = np.array(classes)
+    # The index is written last, so that it only exists for complete shards
+    with _atomic_file(fname) as f:
+        np.savez(f, **packed)
+    return fname
+
+
+def pack_image_folder(root, fname, encoding='jpeg', **kwargs):
+    """Pack the images of a folder of one subfolder per class."""
+    folder = d2l.torchvision.datasets.ImageFolder(root)
+    paths, labels = zip(*folder.samples) if folder.samples else ((), ())
+    return pack_images(list(paths), fname, np.array(labels, dtype=np.int64),
+                       folder.classes, encoding, **kwargs)
+
+
+class PackedImageDataset(torch.utils.data.Dataset):
+    """Images and labels read from the shards written by `pack_images`."""
+    def __init__(self, fname, transform=None):
+        with np.load(fname) as packed:
+            self.index = packed['index']
+            self.encoding = str(packed['encoding'])
+            self.labels = (torch.from_numpy(packed['labels'])
+                           if 'labels' in packed else None)
+            self.classes = (packed['classes'].tolist()
+                            if 'classes' in packed else None)
+        self.fname, self.transform = fname, transform
+        self.shards = {}
+
+    @property
+    def shapes(self):
+        """Shapes (channels, height, width) of the images."""
+        return [tuple(shape) for shape in self.index[:, 3:].tolist()]
+
+    def shard(self, shard):
+        """Memory-map a shard on its first use in this process."""
+        if shard not in self.shards:
+            self.shards[shard] = _map_readonly(
+                _packed_shard_fname(self.fname, shard), np.uint8)
+        return self.shards[shard]
+
+    def __getstate__(self):
+        # Workers started by pickling map the shards themselves
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def __getitem__(self, idx):
+        shard, offset, num_bytes, *shape = self.index[idx].tolist()
+        data = torch.from_numpy(self.shard(shard)[offset:offset + num_bytes])
+        if self.encoding == 'raw':
+            image = data.reshape(shape)
+        else:
+            image = d2l.torchvision.io.decode_jpeg(data)
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.labels is None:
+            return image
+        return image, self.labels[idx]
+
+    def __len__(self):
+        return len(self.index)
+
+
+class PackedImageStream(torch.utils.data.IterableDataset):
+    """Stream the images of `pack_images` shards in order."""
+    def __init__(self, fname, transform=None):
+        self.dataset = PackedImageDataset(fname, transform)
+
+    def __iter__(self):
+        start, end = 0, len(self.dataset)
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            # Each data loader worker reads its own contiguous range of
+            # examples with the index loaded by the main process
+            per_worker = math.ceil(end / worker_info.num_workers)
+            start = worker_info.id * per_worker
+            end = min(start + per_worker, end)
+        for i in range(start, end):
+            yield self.dataset[i]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
 # Defined in file: ./chapter_computer-vision/object-detection-dataset.md
 class BananasDataset(torch.utils.data.Dataset):
     """A customized dataset to load the banana detection dataset."""
-    def __init__(self, is_train):
-        self.features, self.labels = read_data_bananas(is_train)
+    def __init__(self, is_train, lazy=False, cache_size=0):
+        # In the lazy mode, images are decoded in `__getitem__`, keeping the
+        # `cache_size` most recently used ones
+        self.features, self.labels = read_data_bananas(is_train, lazy,
+                                                       cache_size)
         print('read ' + str(len(self.features)) + (
             f' training examples' if is_train else f' validation examples'))
 
@@ -1903,12 +3270,14 @@ class BananasDataset(torch.utils.data.Dataset):
 
 
 # Defined in file: ./chapter_computer-vision/object-detection-dataset.md
-def load_data_bananas(batch_size):
+def load_data_bananas(batch_size, lazy=False, cache_size=0):
     """Load the banana detection dataset."""
-    train_iter = torch.utils.data.DataLoader(BananasDataset(is_train=True),
-                                             batch_size, shuffle=True)
-    val_iter = torch.utils.data.DataLoader(BananasDataset(is_train=False),
-                                           batch_size)
+    train_iter = torch.utils.data.DataLoader(
+        BananasDataset(is_train=True, lazy=lazy, cache_size=cache_size),
+        batch_size, shuffle=True)
+    val_iter = torch.utils.data.DataLoader(
+        BananasDataset(is_train=False, lazy=lazy, cache_size=cache_size),
+        batch_size)
     return train_iter, val_iter
 
 
@@ -1918,25 +3287,87 @@ d2l.DATA_HUB['voc2012'] = (d2l.DATA_URL + 'VOCtrainval_11-May-2012.tar',
 
 
 # Defined in file: ./chapter_computer-vision/semantic-segmentation-and-dataset.md
-def read_voc_images(voc_dir, is_train=True):
+def read_voc_images(voc_dir, is_train=True, label_indices=False, lazy=False,
+                    cache_size=0):
     """Read all VOC feature and label images."""
+    split = 'train' if is_train else 'val'
     txt_fname = os.path.join(voc_dir, 'ImageSets', 'Segmentation',
-                             'train.txt' if is_train else 'val.txt')
-    mode = torchvision.io.image.ImageReadMode.RGB
+                             f'{split}.txt')
+    mode = d2l.torchvision.io.image.ImageReadMode.RGB
     with open(txt_fname, 'r') as f:
         images = f.read().split()
-    features, labels = [], []
-    for i, fname in enumerate(images):
-        features.append(
-            torchvision.io.read_image(
-                os.path.join(voc_dir, 'JPEGImages', f'{fname}.jpg')))
-        labels.append(
-            torchvision.io.read_image(
-                os.path.join(voc_dir, 'SegmentationClass', f'{fname}.png'),
-                mode))
+    feature_paths = [os.path.join(voc_dir, 'JPEGImages', f'{fname}.jpg')
+                     for fname in images]
+    label_paths = [os.path.join(voc_dir, 'SegmentationClass', f'{fname}.png')
+                   for fname in images]
+    if lazy:
+        # Images are only decoded when indexed
+        features = LazyImages(feature_paths, cache_size=cache_size)
+        labels = LazyImages(label_paths, mode, cache_size)
+    else:
+        features = [d2l.torchvision.io.read_image(path)
+                    for path in feature_paths]
+        labels = None if label_indices else [
+            d2l.torchvision.io.read_image(path, mode) for path in label_paths]
+    if label_indices:
+        # Class indices of the labels instead of their RGB images
+        labels = read_voc_label_indices(voc_dir, images, split)
     return features, labels
 
 
+@contextlib.contextmanager
+def _atomic_file(fname):
+    """Open a temporary file that replaces `fname` once closed cleanly."""
+    fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(fname) or '.',
+                                     prefix='.' + os.path.basename(fname))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+
+
+def read_voc_label_indices(voc_dir, images, split):
+    """Return the class indices of VOC labels, decoding them only once."""
+    # The uint8 class indices of all labels of a split are cached next to
+    # the dataset in one file, which is memory-mapped so that data loader
+    # workers share its pages
+    cache_dir = os.path.join(voc_dir, 'SegmentationClassIndex')
+    data_fname = os.path.join(cache_dir, f'{split}.u8')
+    shapes_fname = os.path.join(cache_dir, f'{split}.shapes.npy')
+    try:
+        shapes = np.load(shapes_fname)
+        cached = (shapes.shape == (len(images), 2) and
+                  os.path.getsize(data_fname) == shapes.prod(1).sum())
+    except (OSError, ValueError):
+        cached = False
+    if not cached:
+        os.makedirs(cache_dir, exist_ok=True)
+        mode = d2l.torchvision.io.image.ImageReadMode.RGB
+        colormap2label = voc_colormap2label()
+        shapes = np.zeros((len(images), 2), dtype=np.int64)
+        with _atomic_file(data_fname) as f:
+            for i, fname in enumerate(images):
+                label = voc_label_indices(
+                    d2l.torchvision.io.read_image(
+                        os.path.join(voc_dir, 'SegmentationClass',
+                                     f'{fname}.png'), mode), colormap2label)
+                label.to(torch.uint8).numpy().tofile(f)
+                shapes[i] = label.shape
+        with _atomic_file(shapes_fname) as f:
+            np.save(f, shapes)
+    sizes = shapes.prod(1)
+    if not sizes.sum():
+        return [torch.zeros(tuple(shape), dtype=torch.uint8)
+                for shape in shapes]
+    data = _map_readonly(data_fname, np.uint8)
+    offsets = sizes.cumsum() - sizes
+    return [torch.from_numpy(data[offset:offset + size].reshape(shape))
+            for offset, size, shape in zip(offsets, sizes, shapes)]
+
+
 # Defined in file: ./chapter_computer-vision/semantic-segmentation-and-dataset.md
 VOC_COLORMAP = [[0, 0, 0], [128, 0, 0], [0, 128, 0], [128, 128, 0],
                 [0, 0, 128], [128, 0, 128], [0, 128, 128], [128, 128, 128],
@@ -1954,75 +3385,98 @@ VOC_CLASSES = [
 # Defined in file: ./chapter_computer-vision/semantic-segmentation-and-dataset.md
 def voc_colormap2label():
     """Build the mapping from RGB to class indices for VOC labels."""
-    colormap2label = torch.zeros(256**3, dtype=torch.long)
-    for i, colormap in enumerate(VOC_COLORMAP):
-        colormap2label[(colormap[0] * 256 + colormap[1]) * 256 +
-                       colormap[2]] = i
-    return colormap2label
+    # Rather than a table of all the 256**3 RGB values, keep the sorted RGB
+    # values of the colormap (first row) and their class indices (second row)
+    colormap2label = torch.tensor(
+        [(colormap[0] * 256 + colormap[1]) * 256 + colormap[2]
+         for colormap in VOC_COLORMAP])
+    return torch.stack(torch.sort(colormap2label))
 
 
 def voc_label_indices(colormap, colormap2label):
     """Map any RGB values in VOC labels to their class indices."""
-    colormap = colormap.permute(1, 2, 0).numpy().astype('int32')
-    idx = ((colormap[:, :, 0] * 256 + colormap[:, :, 1]) * 256 +
-           colormap[:, :, 2])
-    return colormap2label[idx]
+    colormap = colormap.long()
+    idx = (colormap[0] * 256 + colormap[1]) * 256 + colormap[2]
+    if colormap2label.dim() == 1:
+        # A table of all the RGB values
+        return colormap2label[idx]
+    # RGB values that are not in the colormap (e.g., object boundaries) are
+    # mapped to the background
+    keys, classes = colormap2label
+    i = torch.searchsorted(keys, idx).clamp_(max=len(keys) - 1)
+    return torch.where(keys[i] == idx, classes[i], 0)
 
 
 # Defined in file: ./chapter_computer-vision/semantic-segmentation-and-dataset.md
 def voc_rand_crop(feature, label, height, width):
     """Randomly crop both feature and label images."""
-    rect = torchvision.transforms.RandomCrop.get_params(
+    rect = d2l.torchvision.transforms.RandomCrop.get_params(
         feature, (height, width))
-    feature = torchvision.transforms.functional.crop(feature, *rect)
-    label = torchvision.transforms.functional.crop(label, *rect)
+    feature = d2l.torchvision.transforms.functional.crop(feature, *rect)
+    label = d2l.torchvision.transforms.functional.crop(label, *rect)
     return feature, label
 
 
 # Defined in file: ./chapter_computer-vision/semantic-segmentation-and-dataset.md
 class VOCSegDataset(torch.utils.data.Dataset):
     """A customized dataset to load the VOC dataset."""
-    def __init__(self, is_train, crop_size, voc_dir):
-        self.transform = torchvision.transforms.Normalize(
+    def __init__(self, is_train, crop_size, voc_dir, lazy=False,
+                 cache_size=0):
+        self.transform = d2l.torchvision.transforms.Normalize(
             mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         self.crop_size = crop_size
-        features, labels = read_voc_images(voc_dir, is_train=is_train)
-        self.features = [
-            self.normalize_image(feature)
-            for feature in self.filter(features)]
+        # Labels are the cached class indices of the label images. In the
+        # lazy mode, features are decoded and normalized in `__getitem__`,
+        # keeping the `cache_size` most recently used decoded ones
+        self.lazy = lazy
+        features, labels = read_voc_images(
+            voc_dir, is_train=is_train, label_indices=True, lazy=lazy,
+            cache_size=cache_size)
+        if lazy:
+            self.features = self.filter(features)
+        else:
+            self.features = [
+                self.normalize_image(feature)
+                for feature in self.filter(features)]
         self.labels = self.filter(labels)
-        self.colormap2label = voc_colormap2label()
         print('read ' + str(len(self.features)) + ' examples')
 
     def normalize_image(self, img):
         return self.transform(img.float())
 
     def filter(self, imgs):
-        return [
-            img for img in imgs if (img.shape[1] >= self.crop_size[0] and
-                                    img.shape[2] >= self.crop_size[1])]
+        lazy = isinstance(imgs, LazyImages)
+        shapes = imgs.shapes if lazy else [img.shape for img in imgs]
+        keep = [i for i, shape in enumerate(shapes)
+                if (shape[-2] >= self.crop_size[0] and
+                    shape[-1] >= self.crop_size[1])]
+        return imgs[keep] if lazy else [imgs[i] for i in keep]
 
     def __getitem__(self, idx):
         feature, label = voc_rand_crop(self.features[idx], self.labels[idx],
                                        *self.crop_size)
-        return (feature, voc_label_indices(label, self.colormap2label))
+        if self.lazy:
+            # Normalizing the crop gives the same values as cropping the
+            # normalized image
+            feature = self.normalize_image(feature)
+        return (feature, label.long())
 
     def __len__(self):
         return len(self.features)
 
 
 # Defined in file: ./chapter_computer-vision/semantic-segmentation-and-dataset.md
-def load_data_voc(batch_size, crop_size):
+def load_data_voc(batch_size, crop_size, lazy=False, cache_size=0):
     """Load the VOC semantic segmentation dataset."""
     voc_dir = d2l.download_extract('voc2012',
                                    os.path.join('VOCdevkit', 'VOC2012'))
     num_workers = d2l.get_dataloader_workers()
     train_iter = torch.utils.data.DataLoader(
-        VOCSegDataset(True, crop_size, voc_dir), batch_size, shuffle=True,
-        drop_last=True, num_workers=num_workers)
+        VOCSegDataset(True, crop_size, voc_dir, lazy, cache_size),
+        batch_size, shuffle=True, drop_last=True, num_workers=num_workers)
     test_iter = torch.utils.data.DataLoader(
-        VOCSegDataset(False, crop_size, voc_dir), batch_size, drop_last=True,
-        num_workers=num_workers)
+        VOCSegDataset(False, crop_size, voc_dir, lazy, cache_size),
+        batch_size, drop_last=True, num_workers=num_workers)
     return train_iter, test_iter
 
 
@@ -2042,13 +3496,71 @@ def read_csv_labels(fname):
 
 
 # Defined in file: ./chapter_computer-vision/kaggle-cifar10.md
-def copyfile(filename, target_dir):
+def copyfile(filename, target_dir, mode='copy'):
     """Copy a file into a target directory."""
     os.makedirs(target_dir, exist_ok=True)
-    shutil.copy(filename, target_dir)
-
-
-def reorg_train_valid(data_dir, labels, valid_ratio):
+    if mode == 'link':
+        # Hard link, reflink or copy, whichever the filesystem supports first
+        _clone_file(filename,
+                    os.path.join(target_dir, os.path.basename(filename)))
+    else:
+        shutil.copy(filename, target_dir)
+
+
+_FICLONE = 0x40049409  # The ioctl of Linux to reflink a file
+
+
+def _clone_file(src, dst):
+    """Create `dst` with the content of `src`, sharing its data if possible."""
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl  # Not available on Windows
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            # Copy-on-write clone, e.g., on Btrfs or XFS
+            fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+        shutil.copymode(src, dst)
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copy(src, dst)
+
+
+def _reorg_files(data_dir, placements, mode, max_workers):
+    """Place (file, split, label) into `train_valid_test/<split>/<label>`."""
+    assert mode in ('link', 'copy', 'virtual'), \
+        'Files are linked, copied or only indexed.'
+    root = os.path.join(data_dir, 'train_valid_test')
+    if mode == 'virtual':
+        # Only write an index of "<file>,<label>" lines per split, with file
+        # names relative to the index
+        indices = collections.defaultdict(list)
+        for fname, split, label in placements:
+            indices[split].append(f'{os.path.relpath(fname, root)},{label}\n')
+        os.makedirs(root, exist_ok=True)
+        for split, lines in indices.items():
+            with open(os.path.join(root, f'{split}.csv'), 'w') as f:
+                f.writelines(lines)
+        return
+
+    def place(chunk):
+        for fname, split, label in chunk:
+            copyfile(fname, os.path.join(root, split, label), mode)
+
+    _map_chunks(place, placements, max_workers,
+                {os.path.join(root, split, label)
+                 for _, split, label in placements})
+
+
+def reorg_train_valid(data_dir, labels, valid_ratio, mode='link',
+                      max_workers=8):
     """Split the validation set out of the original training set."""
     # The number of examples of the class that has the fewest examples in the
     # training dataset
@@ -2056,31 +3568,59 @@ def reorg_train_valid(data_dir, labels, valid_ratio):
     # The number of examples per class for the validation set
     n_valid_per_label = max(1, math.floor(n * valid_ratio))
     label_count = {}
+    placements = []
     for train_file in os.listdir(os.path.join(data_dir, 'train')):
         label = labels[train_file.split('.')[0]]
         fname = os.path.join(data_dir, 'train', train_file)
-        copyfile(
-            fname,
-            os.path.join(data_dir, 'train_valid_test', 'train_valid', label))
+        placements.append((fname, 'train_valid', label))
         if label not in label_count or label_count[label] < n_valid_per_label:
-            copyfile(
-                fname,
-                os.path.join(data_dir, 'train_valid_test', 'valid', label))
+            placements.append((fname, 'valid', label))
             label_count[label] = label_count.get(label, 0) + 1
         else:
-            copyfile(
-                fname,
-                os.path.join(data_dir, 'train_valid_test', 'train', label))
+            placements.append((fname, 'train', label))
+    # Files are hard-linked (or reflinked, or copied if neither works),
+    # copied, or in the virtual mode only listed in index files
+    _reorg_files(data_dir, placements, mode, max_workers)
     return n_valid_per_label
 
 
 # Defined in file: ./chapter_computer-vision/kaggle-cifar10.md
-def reorg_test(data_dir):
+def reorg_test(data_dir, mode='link', max_workers=8):
     """Organize the testing set for data loading during prediction."""
-    for test_file in os.listdir(os.path.join(data_dir, 'test')):
-        copyfile(
-            os.path.join(data_dir, 'test', test_file),
-            os.path.join(data_dir, 'train_valid_test', 'test', 'unknown'))
+    placements = [
+        (os.path.join(data_dir, 'test', test_file), 'test', 'unknown')
+        for test_file in os.listdir(os.path.join(data_dir, 'test'))]
+    _reorg_files(data_dir, placements, mode, max_workers)
+
+
+class VirtualImageFolder(torch.utils.data.Dataset):
+    """An `ImageFolder` of a split reorganized with `mode='virtual'`."""
+    def __init__(self, root, transform=None):
+        # `root` is the folder that the split would have been placed in, e.g.,
+        # `train_valid_test/train`, next to its index `train_valid_test/
+        # train.csv`. Examples are ordered like those of `ImageFolder`
+        index_dir = os.path.dirname(os.path.normpath(root))
+        with open(os.path.normpath(root) + '.csv') as f:
+            samples = [line.rstrip('\n').rsplit(',', 1) for line in f]
+        samples.sort(key=lambda sample: (sample[1],
+                                         os.path.basename(sample[0])))
+        self.classes = sorted({label for _, label in samples})
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.samples = [(os.path.join(index_dir, fname),
+                         self.class_to_idx[label])
+                        for fname, label in samples]
+        self.targets = [target for _, target in self.samples]
+        self.transform = transform
+
+    def __getitem__(self, idx):
+        fname, target = self.samples[idx]
+        img = d2l.torchvision.datasets.folder.default_loader(fname)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, target
+
+    def __len__(self):
+        return len(self.samples)
 
 
 # Defined in file: ./chapter_computer-vision/kaggle-dog.md
@@ -2180,54 +3720,236 @@ def get_negatives(all_contexts, vocab, counter, K):
     return all_negatives
 
 
+def subsample_flat(indices, offsets, vocab, rng=None):
+    """Subsample high-frequency words of a flat corpus of token indices."""
+    # `indices` and `offsets` are the output of `vocab.encode`: sentence i is
+    # `indices[offsets[i]:offsets[i + 1]]`. Return the kept indices, their
+    # sentence offsets and the counts of all tokens before subsampling
+    rng = np.random.default_rng(rng)
+    indices = np.asarray(indices)
+    # Exclude unknown tokens '<unk>'
+    known = indices != vocab.unk
+    counts = np.bincount(indices[known], minlength=len(vocab))
+    num_tokens = counts.sum()
+    # Probability of keeping each token during subsampling
+    with np.errstate(divide='ignore'):
+        keep_probs = np.sqrt(1e-4 / counts * num_tokens)
+    keep = known & (rng.random(len(indices)) < keep_probs[indices])
+    kept_before = np.concatenate(([0], np.cumsum(keep)))
+    return indices[keep], kept_before[offsets], counts
+
+
+def get_centers_and_contexts_flat(indices, offsets, max_window_size,
+                                  rng=None):
+    """Return center words and flat context words in skip-gram."""
+    # Return `centers`, `contexts` and `context_offsets`, where the context
+    # words of `centers[i]` are `contexts[context_offsets[i]:
+    # context_offsets[i + 1]]`
+    rng = np.random.default_rng(rng)
+    lengths = np.diff(offsets)
+    # To form a "center word--context word" pair, each sentence needs to have
+    # at least 2 words
+    starts = np.repeat(offsets[:-1], lengths)
+    ends = np.repeat(offsets[1:], lengths)
+    is_center = np.repeat(lengths >= 2, lengths)
+    positions = np.flatnonzero(is_center)
+    starts, ends = starts[is_center], ends[is_center]
+    # Context window centered at each position
+    window_sizes = rng.integers(1, max_window_size + 1, len(positions))
+    lows = np.maximum(starts, positions - window_sizes)
+    highs = np.minimum(ends, positions + 1 + window_sizes)
+    # Exclude the center word from the context words
+    num_contexts = highs - lows - 1
+    context_offsets = np.concatenate(([0], np.cumsum(num_contexts)))
+    rows = np.repeat(np.arange(len(positions)), num_contexts)
+    context_positions = (lows[rows] + np.arange(context_offsets[-1]) -
+                         context_offsets[rows])
+    context_positions += context_positions >= positions[rows]
+    return indices[positions], indices[context_positions], context_offsets
+
+
+class AliasSampler:
+    """Randomly draw among {1, ..., n} according to n sampling weights."""
+    def __init__(self, sampling_weights, seed=None):
+        # Walker's alias tables with Vose's construction: column i of n
+        # equally likely columns yields i with probability `probs[i]` and
+        # `aliases[i]` otherwise, so each draw takes O(1) time
+        weights = np.asarray(sampling_weights, dtype=np.float64)
+        n = len(weights)
+        scaled = (weights * (n / weights.sum())).tolist()
+        probs, aliases = [1.0] * n, list(range(n))
+        small = [i for i, w in enumerate(scaled) if w < 1]
+        large = [i for i, w in enumerate(scaled) if w >= 1]
+        while small and large:
+            i, j = small.pop(), large.pop()
+            probs[i], aliases[i] = scaled[i], j
+            scaled[j] -= 1 - scaled[i]
+            (small if scaled[j] < 1 else large).append(j)
+        # Columns left in either list are full up to rounding errors
+        self.probs = np.array(probs)
+        self.aliases = np.array(aliases)
+        self.rng = np.random.default_rng(seed)
+
+    def draw(self, size=None):
+        """Draw one index, or an array of `size` indices."""
+        # The integer part of a uniform draw picks a column and the
+        # fractional part decides between the column and its alias
+        u = self.rng.random(size) * len(self.probs)
+        columns = np.minimum(np.asarray(u, dtype=np.int64),
+                             len(self.probs) - 1)
+        draws = 1 + np.where(u - columns < self.probs[columns], columns,
+                             self.aliases[columns])
+        return int(draws) if size is None else draws
+
+
+def sample_negatives(sampler, contexts, context_offsets, K):
+    """Return flat noise words in negative sampling from an `AliasSampler`."""
+    # The noise words of center i are `negatives[K * context_offsets[i]:
+    # K * context_offsets[i + 1]]`
+    contexts = np.asarray(contexts)
+    num_contexts = np.diff(context_offsets)
+    owners = np.repeat(np.arange(len(num_contexts)), K * num_contexts)
+    negatives = np.zeros(len(owners), dtype=contexts.dtype)
+    # Noise words cannot be context words: pad the context words of each
+    # center to a column of a matrix to compare draws with, one row at a time
+    rows = np.repeat(np.arange(len(num_contexts)), num_contexts)
+    padded = np.full((num_contexts.max(initial=0), len(num_contexts)), -1,
+                     dtype=contexts.dtype)
+    padded[np.arange(len(contexts)) - context_offsets[rows], rows] = contexts
+    todo = np.arange(len(owners))
+    while len(todo):
+        # Draw for all remaining slots, keeping the draws that are no
+        # context word of their center
+        draws = sampler.draw(len(todo))
+        centers = owners[todo]
+        rejected = np.zeros(len(todo), dtype=bool)
+        for row in padded:
+            rejected |= row[centers] == draws
+        negatives[todo[~rejected]] = draws[~rejected]
+        todo = todo[rejected]
+    return negatives
+
+
+def get_negatives_flat(contexts, context_offsets, counts, K, rng=None):
+    """Return flat noise words in negative sampling."""
+    # Sampling weights for words with indices 1, 2, ... (index 0 is the
+    # excluded unknown token) in the vocabulary
+    sampler = AliasSampler(np.asarray(counts[1:], dtype=np.float64)**0.75,
+                           rng)
+    return sample_negatives(sampler, contexts, context_offsets, K)
+
+
 # Defined in file: ./chapter_natural-language-processing-pretraining/word-embedding-dataset.md
-def batchify(data):
+def batchify(data, mask_dtype=torch.long):
     """Return a minibatch of examples for skip-gram with negative sampling."""
-    max_len = max(len(c) + len(n) for _, c, n in data)
-    centers, contexts_negatives, masks, labels = [], [], [], []
-    for center, context, negative in data:
-        cur_len = len(context) + len(negative)
-        centers += [center]
-        contexts_negatives += [context + negative + [0] * (max_len - cur_len)]
-        masks += [[1] * cur_len + [0] * (max_len - cur_len)]
-        labels += [[1] * len(context) + [0] * (max_len - len(context))]
-    return (d2l.reshape(d2l.tensor(centers),
-                        (-1, 1)), d2l.tensor(contexts_negatives),
-            d2l.tensor(masks), d2l.tensor(labels))
+    # Write the examples into preallocated tensors through numpy views
+    # instead of building nested lists; `mask_dtype` is the dtype of the
+    # masks and labels, e.g., `torch.float32` for the loss
+    num_contexts = np.fromiter((len(c) for _, c, _ in data), dtype=np.int64,
+                               count=len(data))
+    cur_lens = num_contexts + np.fromiter(
+        (len(n) for _, _, n in data), dtype=np.int64, count=len(data))
+    batch_size, max_len = len(data), int(cur_lens.max())
+    contexts_negatives = torch.zeros((batch_size, max_len), dtype=torch.long)
+    masks, labels = torch.empty((2, batch_size, max_len), dtype=mask_dtype)
+    steps = np.arange(max_len)
+    valid = steps < cur_lens[:, None]
+    # Boolean indexing follows row-major order, so the concatenated context
+    # and noise words of all examples fill the valid positions
+    contexts_negatives.numpy()[valid] = np.fromiter(
+        itertools.chain.from_iterable(c + n for _, c, n in data),
+        dtype=np.int64, count=cur_lens.sum())
+    masks.numpy()[:] = valid
+    labels.numpy()[:] = steps < num_contexts[:, None]
+    centers = torch.tensor([center for center, _, _ in data])
+    return d2l.reshape(centers, (-1, 1)), contexts_negatives, masks, labels
+
+
+class NegativeSamplingBatchify:
+    """Draw noise words for a minibatch of (center, contexts) examples."""
+    def __init__(self, sampler, K):
+        self.sampler = sampler
+        self.K = K
+        self._worker_seed = None
+
+    def __call__(self, data):
+        # Copies of the sampler in data loader workers would all draw the
+        # same noise words: reseed it with the seed of the worker, which
+        # differs across workers and epochs
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None and worker_info.seed != self._worker_seed:
+            self._worker_seed = worker_info.seed
+            self.sampler.rng = np.random.default_rng(worker_info.seed)
+        context_offsets = np.concatenate(
+            ([0], np.cumsum([len(context) for _, context in data])))
+        contexts = np.fromiter(
+            itertools.chain.from_iterable(c for _, c in data),
+            dtype=np.int64, count=context_offsets[-1])
+        negatives = sample_negatives(self.sampler, contexts, context_offsets,
+                                     self.K).tolist()
+        offsets = (self.K * context_offsets).tolist()
+        return batchify([
+            (center, context, negatives[offsets[i]:offsets[i + 1]])
+            for i, (center, context) in enumerate(data)])
 
 
 # Defined in file: ./chapter_natural-language-processing-pretraining/word-embedding-dataset.md
-def load_data_ptb(batch_size, max_window_size, num_noise_words):
+def load_data_ptb(batch_size, max_window_size, num_noise_words, seed=None,
+                  resample_negatives=False, pin_memory=False):
     """Download the PTB dataset and then load it into memory."""
     num_workers = d2l.get_dataloader_workers()
     sentences = read_ptb()
     vocab = d2l.Vocab(sentences, min_freq=10)
-    subsampled, counter = subsample(sentences, vocab)
-    corpus = [vocab[line] for line in subsampled]
-    all_centers, all_contexts = get_centers_and_contexts(
-        corpus, max_window_size)
-    all_negatives = get_negatives(all_contexts, vocab, counter,
-                                  num_noise_words)
+    # Work on flat arrays of token indices; `seed` makes the random
+    # subsampling, windows and noise words reproducible
+    rng = np.random.default_rng(seed)
+    indices, offsets, counts = subsample_flat(*vocab.encode(sentences),
+                                              vocab, rng)
+    all_centers, all_contexts, context_offsets = \
+        get_centers_and_contexts_flat(indices, offsets, max_window_size, rng)
+    sampler = AliasSampler(np.asarray(counts[1:], dtype=np.float64)**0.75,
+                           rng)
+    if resample_negatives:
+        # Draw new noise words for every minibatch while loading
+        all_negatives = None
+        collate_fn = NegativeSamplingBatchify(sampler, num_noise_words)
+    else:
+        all_negatives = sample_negatives(sampler, all_contexts,
+                                         context_offsets, num_noise_words)
+        collate_fn = batchify
 
     class PTBDataset(torch.utils.data.Dataset):
-        def __init__(self, centers, contexts, negatives):
-            assert len(centers) == len(contexts) == len(negatives)
+        def __init__(self, centers, contexts, negatives, offsets, K):
+            assert len(centers) == len(offsets) - 1
+            assert negatives is None or len(negatives) == K * len(contexts)
             self.centers = centers
             self.contexts = contexts
             self.negatives = negatives
+            self.offsets = offsets
+            self.K = K
 
         def __getitem__(self, index):
-            return (self.centers[index], self.contexts[index],
-                    self.negatives[index])
+            start, end = self.offsets[index], self.offsets[index + 1]
+            center = int(self.centers[index])
+            context = self.contexts[start:end].tolist()
+            if self.negatives is None:
+                return center, context
+            return (center, context,
+                    self.negatives[self.K * start:self.K * end].tolist())
 
         def __len__(self):
             return len(self.centers)
 
-    dataset = PTBDataset(all_centers, all_contexts, all_negatives)
-
+    dataset = PTBDataset(all_centers, all_contexts, all_negatives,
+                         context_offsets, num_noise_words)
+    # With a seed, the shuffling and the seeds of the workers are
+    # reproducible as well
+    generator = None if seed is None else torch.Generator().manual_seed(seed)
     data_iter = torch.utils.data.DataLoader(dataset, batch_size, shuffle=True,
-                                            collate_fn=batchify,
-                                            num_workers=num_workers)
+                                            collate_fn=collate_fn,
+                                            num_workers=num_workers,
+                                            generator=generator,
+                                            pin_memory=pin_memory)
     return data_iter, vocab
 
 
@@ -2245,6 +3967,65 @@ d2l.DATA_HUB['wiki.en'] = (d2l.DATA_URL + 'wiki.en.zip',
                            'c1816da3821ae9f43899be655002f6c723e91b88')
 
 
+def _convert_embedding(vec_fname, data_fname, tokens_fname, meta_fname,
+                       chunk_size=10000):
+    """Convert text word vectors into a float32 matrix and a token file."""
+    # Row 0 holds the zero vector of the unknown token '<unk>'. The vectors
+    # are parsed in chunks of lines and streamed to the files
+    idx_to_token, dim = ['<unk>'], None
+    st = os.stat(vec_fname)
+    with open(vec_fname, 'r') as f, _atomic_file(data_fname) as data, \
+            _atomic_file(tokens_fname) as tokens:
+        tokens.write('<unk>\n'.encode('utf-8'))
+        for chunk in iter(lambda: list(itertools.islice(f, chunk_size)), []):
+            # Skip header information, such as the top row in fastText
+            rows = [row for row in (line.rstrip().partition(' ')
+                                    for line in chunk) if ' ' in row[2]]
+            if not rows:
+                continue
+            if dim is None:
+                dim = rows[0][2].count(' ') + 1
+                np.zeros(dim, dtype=np.float32).tofile(data)
+            # Parse in float64 like `float` before rounding to float32
+            vecs = np.fromstring(' '.join(row[2] for row in rows), sep=' ')
+            if vecs.size != len(rows) * dim:
+                raise ValueError(f'Vectors in {vec_fname} have different '
+                                 f'lengths or invalid values.')
+            vecs.astype(np.float32).tofile(data)
+            chunk_tokens = [row[0] for row in rows]
+            tokens.write(''.join(
+                token + '\n' for token in chunk_tokens).encode('utf-8'))
+            idx_to_token += chunk_tokens
+        if dim is None:
+            raise ValueError(f'No word vectors in {vec_fname}.')
+    # Written last: the cache is only used once its description matches
+    with _atomic_file(meta_fname) as f:
+        f.write(json.dumps({'rows': len(idx_to_token), 'dim': dim,
+                            'size': st.st_size,
+                            'mtime': st.st_mtime_ns}).encode('utf-8'))
+    return idx_to_token, dim
+
+
+def _read_embedding_cache(vec_fname, data_fname, tokens_fname, meta_fname):
+    """Return the tokens and dimension of a valid embedding cache, or None."""
+    # The cache is stale once `vec.txt` changes, e.g., when it was extracted
+    # again, and incomplete unless the matrix has all the rows and columns
+    try:
+        with open(meta_fname) as f:
+            meta = json.load(f)
+        st = os.stat(vec_fname)
+        rows, dim = meta['rows'], meta['dim']
+        if ((meta['size'], meta['mtime']) != (st.st_size, st.st_mtime_ns)
+                or rows <= 0 or dim <= 0 or
+                os.path.getsize(data_fname) != 4 * rows * dim):
+            return None
+        with open(tokens_fname, encoding='utf-8', newline='') as f:
+            idx_to_token = f.read().split('\n')[:-1]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return (idx_to_token, dim) if len(idx_to_token) == rows else None
+
+
 # Defined in file: ./chapter_natural-language-processing-pretraining/similarity-analogy.md
 class TokenEmbedding:
     """Token Embedding."""
@@ -2256,20 +4037,19 @@ class TokenEmbedding:
             token: idx for idx, token in enumerate(self.idx_to_token)}
 
     def _load_embedding(self, embedding_name):
-        idx_to_token, idx_to_vec = ['<unk>'], []
         data_dir = d2l.download_extract(embedding_name)
         # GloVe website: https://nlp.stanford.edu/projects/glove/
         # fastText website: https://fasttext.cc/
-        with open(os.path.join(data_dir, 'vec.txt'), 'r') as f:
-            for line in f:
-                elems = line.rstrip().split(' ')
-                token, elems = elems[0], [float(elem) for elem in elems[1:]]
-                # Skip header information, such as the top row in fastText
-                if len(elems) > 1:
-                    idx_to_token.append(token)
-                    idx_to_vec.append(elems)
-        idx_to_vec = [[0] * len(idx_to_vec[0])] + idx_to_vec
-        return idx_to_token, d2l.tensor(idx_to_vec)
+        # The text vectors are converted once into a float32 matrix and a
+        # token file next to them; the matrix is memory-mapped so that
+        # processes loading the same embedding share its pages
+        fnames = [os.path.join(data_dir, name) for name in (
+            'vec.txt', 'vec.f32', 'vec.tokens', 'vec.meta.json')]
+        cache = _read_embedding_cache(*fnames)
+        idx_to_token, dim = cache if cache else _convert_embedding(*fnames)
+        idx_to_vec = _map_readonly(fnames[1], np.float32,
+                                   (len(idx_to_token), dim))
+        return idx_to_token, torch.from_numpy(idx_to_vec)
 
     def __getitem__(self, tokens):
         indices = [
@@ -2300,7 +4080,7 @@ class BERTEncoder(nn.Module):
     def __init__(self, vocab_size, num_hiddens, norm_shape, ffn_num_input,
                  ffn_num_hiddens, num_heads, num_layers, dropout,
                  max_len=1000, key_size=768, query_size=768, value_size=768,
-                 **kwargs):
+                 chunk_size=None, **kwargs):
         super(BERTEncoder, self).__init__(**kwargs)
         self.token_embedding = nn.Embedding(vocab_size, num_hiddens)
         self.segment_embedding = nn.Embedding(2, num_hiddens)
@@ -2310,7 +4090,8 @@ class BERTEncoder(nn.Module):
                 f"{i}",
                 d2l.EncoderBlock(key_size, query_size, value_size,
                                  num_hiddens, norm_shape, ffn_num_input,
-                                 ffn_num_hiddens, num_heads, dropout, True))
+                                 ffn_num_hiddens, num_heads, dropout, True,
+                                 chunk_size=chunk_size))
         # In BERT, positional embeddings are learnable, thus we create a
         # parameter of positional embeddings that are long enough
         self.pos_embedding = nn.Parameter(torch.randn(1, max_len,
@@ -2368,13 +4149,14 @@ class BERTModel(nn.Module):
                  ffn_num_hiddens, num_heads, num_layers, dropout,
                  max_len=1000, key_size=768, query_size=768, value_size=768,
                  hid_in_features=768, mlm_in_features=768,
-                 nsp_in_features=768):
+                 nsp_in_features=768, chunk_size=None):
         super(BERTModel, self).__init__()
         self.encoder = BERTEncoder(vocab_size, num_hiddens, norm_shape,
                                    ffn_num_input, ffn_num_hiddens, num_heads,
                                    num_layers, dropout, max_len=max_len,
                                    key_size=key_size, query_size=query_size,
-                                   value_size=value_size)
+                                   value_size=value_size,
+                                   chunk_size=chunk_size)
         self.hidden = nn.Sequential(nn.Linear(hid_in_features, num_hiddens),
                                     nn.Tanh())
         self.mlm = MaskLM(vocab_size, num_hiddens, mlm_in_features)
@@ -2621,12 +4403,12 @@ def load_data_imdb(batch_size, num_steps=500):
     train_tokens = d2l.tokenize(train_data[0], token='word')
     test_tokens = d2l.tokenize(test_data[0], token='word')
     vocab = d2l.Vocab(train_tokens, min_freq=5)
-    train_features = torch.tensor([
-        d2l.truncate_pad(vocab[line], num_steps, vocab['<pad>'])
-        for line in train_tokens])
-    test_features = torch.tensor([
-        d2l.truncate_pad(vocab[line], num_steps, vocab['<pad>'])
-        for line in test_tokens])
+    train_features = torch.from_numpy(
+        d2l.truncate_pad_encoded(*vocab.encode(train_tokens), num_steps,
+                                 vocab['<pad>'])).long()
+    test_features = torch.from_numpy(
+        d2l.truncate_pad_encoded(*vocab.encode(test_tokens), num_steps,
+                                 vocab['<pad>'])).long()
     train_iter = d2l.load_array((train_features, torch.tensor(train_data[1])),
                                 batch_size)
     test_iter = d2l.load_array((test_features, torch.tensor(test_data[1])),
@@ -2687,9 +4469,10 @@ class SNLIDataset(torch.utils.data.Dataset):
         print('read ' + str(len(self.premises)) + ' examples')
 
     def _pad(self, lines):
-        return torch.tensor([
-            d2l.truncate_pad(self.vocab[line], self.num_steps,
-                             self.vocab['<pad>']) for line in lines])
+        return torch.from_numpy(
+            d2l.truncate_pad_encoded(*self.vocab.encode(lines),
+                                     self.num_steps,
+                                     self.vocab['<pad>'])).long()
 
     def __getitem__(self, idx):
         return (self.premises[idx], self.hypotheses[idx]), self.labels[idx]